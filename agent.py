@@ -1,32 +1,320 @@
 import json
 import argparse
 import os
+import sys
+import threading
+import time
+import contextvars
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from nodes import (ReportStructureNode, FirstSearchNode, FirstSummaryNode, 
-                  ReflectionNode, ReflectionSummaryNode, ReportFormattingNode)
+from nodes import (ReportStructureNode, FirstSearchNode, FirstSummaryNode,
+                  ReflectionNode, ReflectionSummaryNode, ReportFormattingNode,
+                  SectionFormattingNode, ReportOutlineNode)
 from state import State
-from tools import tavily_search
+from journal import Journal, load_results
+from dedup import SearchDeduplicator
+from context import pack_search_results
+from tools import search_many
 from utils import update_state_with_search_results
-from llms import ZhipuAILLM
+from llms import with_llm_cache, with_tracing
+from router import create_llm_client, router_stats
+from ratelimit import rate_limit_stats
+from hedging import hedge_stats
+from tracing import trace_context, get_tracer, enable_tracing, record_event
+from convergence import ConvergencePolicy, COMPLETED, STOP_REASONS
 from config import (
-    ZHIPUAI_API_KEY, 
-    NUM_REFLECTIONS, 
-    NUM_RESULTS_PER_SEARCH, 
-    CAP_SEARCH_LENGTH
+    NUM_REFLECTIONS,
+    NUM_RESULTS_PER_SEARCH,
+    FIRST_SUMMARY_TOKEN_BUDGET,
+    REFLECTION_SUMMARY_TOKEN_BUDGET,
+    MAX_CONCURRENT_PARAGRAPHS,
+    BATCH_WORKERS,
+    REPORT_FORMATTING_MODE,
+    STREAM_REPORT_STRUCTURE
 )
 
 # 全局配置
 STATE = State()
 QUERY = "2025年黄金"
+OUTLINE_DIGEST_CHARS = 400  # 分段格式化模式下，生成报告框架时每一节发送的摘录长度
 # NUM_REFLECTIONS = 2  # 反思次数
 # NUM_RESULTS_PER_SEARCH = 3  # 每次搜索结果数
-# CAP_SEARCH_LENGTH = 20000  # 搜索内容截断长度
 
-def main(topic: str = QUERY):
-    # 初始化LLM客户端
-    # llm_client = GeminiLLM(GEMINI_API_KEY)
-    llm_client = ZhipuAILLM(ZHIPUAI_API_KEY)
+def print_search_results(search_results, log=print):
+    for idx, result in enumerate(search_results, 1):
+        log(f"\n结果 {idx}:")
+        log(f"标题: {result['title']}")
+        log(f"链接: {result['url']}")
+        log(f"摘要: {result['content'][:200]}...")
+
+def replayed(state, op, j, n):
+    """恢复运行时返回日志中已完成的步骤，未开启日志或尚未完成时返回 None"""
+    return state.journal.get(op, j, n) if state.journal is not None else None
+
+def search_step(j, n, query, state, deduplicator=None, log=print):
+    """执行段落的第 n 次搜索（恢复运行时直接取日志中的结果），去掉重复结果后写入状态
+
+    query 可以是一个查询或查询列表；多个查询并发搜索，合并后的结果作为这一轮的搜索结果"""
+    event = replayed(state, "search_results", j, n)
+    if event:
+        search_results = load_results(event["results"])
+        if deduplicator is not None:
+            deduplicator.register(search_results, j)
+        return search_results
+
+    queries = [query] if isinstance(query, str) or query is None else list(query)
+    # 先查本地语料库，本地结果不够时才调用网络搜索；去重在合并前进行，被去掉的本地结果不计入召回
+    dropped, unfiltered = [], []
+    def keep(results):
+        kept = deduplicator.filter(results, j)
+        dropped.append(len(results) - len(kept))
+        unfiltered.extend(results)
+        return kept
+    search_results = search_many(queries, max_results=NUM_RESULTS_PER_SEARCH,
+                                 keep=keep if deduplicator is not None else None)
+    if sum(dropped):
+        log(f"\n[去重] 过滤掉 {sum(dropped)} 条重复结果")
+    if n == 0 and not search_results and unfiltered:
+        # 初始搜索的结果全部被去重时改用未去重的结果，保证初始总结有材料可用
+        seen = set()
+        search_results = [result for result in unfiltered if not (result["url"] in seen or seen.add(result["url"]))]
+        search_results = search_results[:NUM_RESULTS_PER_SEARCH * len(queries)]
+        deduplicator.register(search_results, j)
+        log(f"\n[去重] 初始搜索结果均已被其他段落使用，保留 {len(search_results)} 条未去重的结果")
+    local = sum(1 for result in search_results if result.get("source") == "local")
+    if local:
+        log(f"\n[本地语料库] 召回 {local} 条结果")
+    _ = update_state_with_search_results(search_results, j, state)
+    return search_results
+
+def research_paragraph(j, state, first_search_node, first_summary_node,
+                       reflection_node, reflection_summary_node, log=print, deduplicator=None):
+    """对单个段落执行初始搜索、初始总结和反思循环，只写入 state.paragraphs[j]
+
+    恢复运行时，日志中已完成的查询、搜索和总结直接复用，不会重复调用网络。
+    反思循环由 ConvergencePolicy 判断是否提前结束，结束原因写入日志、追踪和 research.stop_reason"""
+    paragraph = state.paragraphs[j]
+    policy = ConvergencePolicy()
+    log(f"\n\n============== 段落 {j+1} ==============\n")
+    log(f"============== {paragraph.title} ==============\n")
+
+    # 初始搜索
+    with trace_context(paragraph=j, round=0):
+        event = replayed(state, "query", j, 0)
+        if event:
+            output = event["output"]
+        else:
+            message = json.dumps({"title": paragraph.title, "content": paragraph.content}, ensure_ascii=False)
+            policy.spend(message)
+            output = first_search_node.run(message)
+            state.record("query", idx=j, output=output)
+        log("\n[初始搜索] 查询:", output.get("search_query"))
+        log("[初始搜索] 推理:", output.get("reasoning"))
+        policy.check_queries([output.get("search_query")])
+
+        search_results = search_step(j, 0, output.get("search_query"), state, deduplicator, log)
+        log("\n[搜索结果]:")
+        print_search_results(search_results, log)
+        policy.check_results(search_results)
+
+        # 初始总结
+        if not replayed(state, "summary", j, 0):
+            message = {
+                "title": paragraph.title,
+                "content": paragraph.content,
+                "search_query": output.get("search_query"),
+                "search_results": pack_search_results(search_results, f"{paragraph.title} {paragraph.content} {output.get('search_query')}", FIRST_SUMMARY_TOKEN_BUDGET)
+            }
+            message = json.dumps(message, ensure_ascii=False)
+            policy.spend(message)
+            _ = first_summary_node.mutate_state(message, j, state)
+        policy.spend(paragraph.research.latest_summary)
+        log("\n[初始总结]:")
+        log(paragraph.research.latest_summary)
+
+    # 反思循环；恢复运行时，若上次已提前停止，只回放到停止前的轮次
+    stop = replayed(state, "stop", j, 0)
+    reason, last_round = (stop["reason"], stop["round"]) if stop else (COMPLETED, NUM_REFLECTIONS)
+    for i in range(last_round):
+        with trace_context(paragraph=j, round=i + 1):
+            early = None if stop else policy.check_budget()
+            if early:
+                reason, last_round = early, i
+                break
+
+            log(f"\n[反思 {i+1}] 开始...")
+            event = replayed(state, "query", j, i + 1)
+            if event:
+                output = event["output"]
+            else:
+                message = {
+                    "paragraph_latest_state": paragraph.research.latest_summary,
+                    "title": paragraph.title,
+                    "content": paragraph.content
+                }
+                message = json.dumps(message, ensure_ascii=False)
+                policy.spend(message)
+                output = reflection_node.run(message)
+                state.record("query", idx=j, output=output)
+            queries = [str(q) for q in output.get("search_queries") or [output.get("search_query")]]
+            log(f"\n[反思 {i+1}] 查询:", "；".join(queries))
+            log(f"[反思 {i+1}] 推理:", output.get("reasoning"))
+            early = policy.check_queries(queries)
+            if early and not stop:
+                reason, last_round = early, i
+                break
+
+            search_results = search_step(j, i + 1, queries, state, deduplicator, log)
+            log(f"\n[反思 {i+1}] 搜索结果:")
+            print_search_results(search_results, log)
+            early = policy.check_results(search_results)
+            if early and not stop:
+                reason, last_round = early, i
+                break
+
+            if not search_results:
+                # 去重后没有新的结果，总结只会凭空改写，跳过本轮总结；仍记录一条未改动的总结事件，
+                # 保持日志中总结事件的序号与反思轮次一致，恢复运行时才能按轮次找到之后的总结
+                log(f"\n[反思 {i+1}] 没有新的搜索结果，跳过总结")
+                if not replayed(state, "summary", j, i + 1):
+                    paragraph.research.reflection_iteration += 1
+                    state.record("summary", idx=j, summary=paragraph.research.latest_summary, skipped=True)
+                continue
+
+            before = paragraph.research.latest_summary
+            if not replayed(state, "summary", j, i + 1):
+                message = {
+                    "title": paragraph.title,
+                    "content": paragraph.content,
+                    "search_query": "；".join(queries),
+                    "search_results": pack_search_results(search_results, f"{paragraph.title} {paragraph.content} {' '.join(queries)}", REFLECTION_SUMMARY_TOKEN_BUDGET),
+                    "paragraph_latest_state": paragraph.research.latest_summary
+                }
+                message = json.dumps(message, ensure_ascii=False)
+                policy.spend(message)
+                _ = reflection_summary_node.mutate_state(message, j, state)
+            policy.spend(paragraph.research.latest_summary)
+            log(f"\n[反思 {i+1}] 更新总结:")
+            log(paragraph.research.latest_summary)
+            early = policy.check_summary(before, paragraph.research.latest_summary)
+            if early and not stop:
+                reason, last_round = early, i + 1
+                break
+
+    # 记录反思循环结束的原因；last_round 为最后一轮写入总结的反思轮次
+    paragraph.research.stop_reason = reason
+    if not stop:
+        state.record("stop", idx=j, reason=reason, round=last_round)
+    record_event("paragraph_stop", "convergence", paragraph=j, round=last_round, reason=reason,
+                 estimated_tokens=policy.tokens)
+    if reason != COMPLETED:
+        log(f"\n[反思] 第 {last_round} 轮后停止：{STOP_REASONS.get(reason, reason)}")
+    return state
+
+def format_section(j, state, section_formatting_node, log=print):
+    """分段格式化模式：把研究完成的段落格式化为报告章节（恢复运行时直接取日志中的章节）"""
+    paragraph = state.paragraphs[j]
+    if not replayed(state, "section", j, 0):
+        message = {"title": paragraph.title, "content": paragraph.content,
+                   "paragraph_latest_state": paragraph.research.latest_summary}
+        with trace_context(paragraph=j):
+            _ = section_formatting_node.mutate_state(json.dumps(message, ensure_ascii=False), j, state)
+    log(f"\n[章节 {j+1}] 已格式化（{len(paragraph.section)} 字符）")
+    return state
+
+def research_paragraphs(state, nodes, max_workers=MAX_CONCURRENT_PARAGRAPHS, deduplicator=None, log=print,
+                        section_formatting_node=None, indices=None):
+    """并发研究所有段落，并按段落顺序输出各自的进度日志
+
+    传入 section_formatting_node 时，每个段落研究完成后立即在同一个工作线程中格式化为章节。
+    indices 为要研究的段落序号（默认全部段落），可以是流式生成报告结构时逐个产生序号的迭代器，
+    每个段落一出现就提交研究，与报告结构的生成重叠"""
+    indices = range(len(state.paragraphs)) if indices is None else indices
+    def research(j, log):
+        research_paragraph(j, state, *nodes, log=log, deduplicator=deduplicator)
+        if section_formatting_node is not None:
+            format_section(j, state, section_formatting_node, log)
+        return state
+
+    if max_workers <= 1:
+        # 串行时先取完所有序号，避免长时间暂停读取流式输出
+        for j in list(indices):
+            research(j, log)
+        return state
+
+    def run(j, lines):
+        buffered = lambda *args: lines.append(" ".join(str(arg) for arg in args))
+        return research(j, buffered)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures, buffers = [], []
+        for j in indices:
+            buffers.append([])
+            # 每个任务复制一份当前上下文，让追踪属性（运行 ID 等）跟随到工作线程
+            futures.append(executor.submit(contextvars.copy_context().run, run, j, buffers[-1]))
+        # 按顺序等待：段落 j 完成后立即打印，慢段落不会打乱输出顺序
+        for future, lines in zip(futures, buffers):
+            future.result()
+            for line in lines:
+                log(line)
+    return state
+
+def announce_paragraphs(state, indices, log=print):
+    """逐个输出段落标题并原样返回段落序号"""
+    for j in indices:
+        log(f"\n段落 {j + 1}: {state.paragraphs[j].title}")
+        yield j
+
+def export_trace(journal, log=print):
+    """开启追踪时，把本次运行的调用记录导出到运行目录下的 trace.json 并打印汇总；
+    发生过限流或重试时同时打印各服务商限流器的状态，发出过对冲请求或超时时打印对冲统计，服务商出错时打印路由统计（均为进程内累计）"""
+    for provider, stats in rate_limit_stats().items():
+        if stats["retries"] or stats["throttled"]:
+            log(f"[限流] {provider}: {stats}")
+    for key, stats in hedge_stats().items():
+        if stats["hedged"] or stats["deadline_exceeded"]:
+            log(f"[对冲] {key}: {stats}")
+    for key, stats in router_stats().items():
+        if stats["errors"]:
+            log(f"[路由] {key}: {stats}")
+    tracer = get_tracer()
+    if tracer is None:
+        return
+    summary = tracer.summary(journal.run_id)  # 导出后事件会从内存中移除，先汇总
+    path = tracer.export(os.path.join(os.path.dirname(journal.path), "trace.json"), run=journal.run_id)
+    for name, counters in summary.items():
+        log(f"[追踪] {name}: {counters}")
+    log(f"追踪已保存至: {path}")
+
+def quiet(*args, **kwargs):
+    """不输出任何内容的 log，批量模式下使用"""
+
+def report_chunks(state, report_formatting_node, report_outline_node=None):
+    """生成最终报告的 Markdown 片段
+
+    未传入 report_outline_node 时由 report_formatting_node 流式生成整篇报告；
+    否则各段落已格式化为章节，只需生成标题、引言、结论和章节顺序，再拼接章节"""
+    if report_outline_node is None:
+        report_data = [{"title": p.title, "paragraph_latest_state": p.research.latest_summary} for p in state.paragraphs]
+        return report_formatting_node.stream(json.dumps(report_data, ensure_ascii=False))
+    # 只发送每一节的开头摘录，提示词大小与章节长度无关
+    sections = [p.section or f"## {p.title}\n\n{p.research.latest_summary}" for p in state.paragraphs]
+    digests = [{"index": i, "title": p.title, "digest": sections[i].split("\n", 1)[-1].strip()[:OUTLINE_DIGEST_CHARS]}
+               for i, p in enumerate(state.paragraphs)]
+    outline = report_outline_node.run(json.dumps(digests, ensure_ascii=False))
+    return report_outline_node.render(outline, sections)
+
+def run_research(topic, llm_client, state=None, max_workers=MAX_CONCURRENT_PARAGRAPHS, resume=None,
+                 filename=None, run_id=None, log=print, formatting_mode=REPORT_FORMATTING_MODE,
+                 stream_structure=STREAM_REPORT_STRUCTURE):
+    """完整执行一个主题的研究并保存报告，返回报告路径
+
+    llm_client 可以在多个主题之间共享；每个主题使用独立的 State 和运行日志。
+    formatting_mode 为 map_reduce 时，段落研究完成后立即格式化为章节，最后只生成报告框架。
+    stream_structure 为 True 时流式解析报告结构，段落研究与报告结构的生成重叠。"""
+    llm_client = with_tracing(llm_client)
 
     # 创建所有节点实例
     report_structure_node = ReportStructureNode(llm_client, topic)
@@ -35,95 +323,141 @@ def main(topic: str = QUERY):
     reflection_node = ReflectionNode(llm_client)
     reflection_summary_node = ReflectionSummaryNode(llm_client)
     report_formatting_node = ReportFormattingNode(llm_client)
+    map_reduce = formatting_mode == "map_reduce"
+    section_formatting_node = SectionFormattingNode(llm_client) if map_reduce else None
+    report_outline_node = ReportOutlineNode(llm_client) if map_reduce else None
 
-    # Step 1: 生成报告结构并更新状态
-    _ = report_structure_node.mutate_state(STATE)
-    print(f"总段落数: {len(STATE.paragraphs)}")
-    for idx, paragraph in enumerate(STATE.paragraphs, 1):
-        print(f"\n段落 {idx}: {paragraph.title}")
-
-    # Step 2: 遍历每个段落，执行搜索和反思
-    for j in range(len(STATE.paragraphs)):
-        print(f"\n\n============== 段落 {j+1} ==============\n")
-        print(f"============== {STATE.paragraphs[j].title} ==============\n")
-
-        # 初始搜索
-        message = json.dumps({"title": STATE.paragraphs[j].title, "content": STATE.paragraphs[j].content}, ensure_ascii=False)
-        output = first_search_node.run(message)
-        print("\n[初始搜索] 查询:", output.get("search_query"))
-        print("[初始搜索] 推理:", output.get("reasoning"))
-        
-        search_results = tavily_search(output.get("search_query"), max_results=NUM_RESULTS_PER_SEARCH)
-        print("\n[搜索结果]:")
-        for idx, result in enumerate(search_results, 1):
-            print(f"\n结果 {idx}:")
-            print(f"标题: {result['title']}")
-            print(f"链接: {result['url']}")
-            print(f"摘要: {result['content'][:200]}...")
-        
-        _ = update_state_with_search_results(search_results, j, STATE)
-        
-        # 初始总结
-        message = {
-            "title": STATE.paragraphs[j].title,
-            "content": STATE.paragraphs[j].content,
-            "search_query": output.get("search_query"),
-            "search_results": [result["content"][:CAP_SEARCH_LENGTH] for result in search_results if result["content"]]
-        }
-        _ = first_summary_node.mutate_state(json.dumps(message, ensure_ascii=False), j, STATE)
-        print("\n[初始总结]:")
-        print(STATE.paragraphs[j].research.latest_summary)
-        
-        # 反思循环
-        for i in range(NUM_REFLECTIONS):
-            print(f"\n[反思 {i+1}] 开始...")
-            message = {
-                "paragraph_latest_state": STATE.paragraphs[j].research.latest_summary,
-                "title": STATE.paragraphs[j].title,
-                "content": STATE.paragraphs[j].content
-            }
-            output = reflection_node.run(json.dumps(message, ensure_ascii=False))
-            print(f"\n[反思 {i+1}] 查询:", output.get("search_query"))
-            print(f"[反思 {i+1}] 推理:", output.get("reasoning"))
-            
-            search_results = tavily_search(output.get("search_query"), max_results=NUM_RESULTS_PER_SEARCH)
-            print(f"\n[反思 {i+1}] 搜索结果:")
-            for idx, result in enumerate(search_results, 1):
-                print(f"\n结果 {idx}:")
-                print(f"标题: {result['title']}")
-                print(f"链接: {result['url']}")
-                print(f"摘要: {result['content'][:200]}...")
-            
-            _ = update_state_with_search_results(search_results, j, STATE)
-            
-            message = {
-                "title": STATE.paragraphs[j].title,
-                "content": STATE.paragraphs[j].content,
-                "search_query": output.get("search_query"),
-                "search_results": [result["content"][:CAP_SEARCH_LENGTH] for result in search_results if result["content"]],
-                "paragraph_latest_state": STATE.paragraphs[j].research.latest_summary
-            }
-            _ = reflection_summary_node.mutate_state(json.dumps(message, ensure_ascii=False), j, STATE)
-            print(f"\n[反思 {i+1}] 更新总结:")
-            print(STATE.paragraphs[j].research.latest_summary)
-
-    # Step 3: 生成最终报告
-    print("\n=============== 最终报告生成 ===============\n")
-    report_data = [{"title": p.title, "paragraph_latest_state": p.research.latest_summary} for p in STATE.paragraphs]
-    final_report = report_formatting_node.run(json.dumps(report_data, ensure_ascii=False))
-    
-    print("\n=============== 最终报告 ===============\n")
-    print(final_report)
-
-    # 保存到文件
-    os.makedirs("reports", exist_ok=True)
-    filename = f"reports/report_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.md"
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(final_report)
-    print(f"\n报告已保存至: {filename}")
+    # 每次运行都写入追加式日志；恢复时回放日志重建状态，并从第一个未完成的步骤继续
+    if resume:
+        journal = Journal(resume)
+        state = journal.replay()
+        report_structure_node.query = journal.topic
+        log(f"恢复运行: {resume}（主题: {journal.topic}）")
+    else:
+        journal = Journal(run_id or Journal.new_run_id())
+        state = state if state is not None else State()
+        journal.append("run", topic=topic)
+        log(f"运行 ID: {journal.run_id}（中断后可使用 --resume {journal.run_id} 继续）")
+    state.journal = journal
+
+    try:
+        with trace_context(run=journal.run_id):
+            # Step 1: 生成报告结构并更新状态
+            indices = None
+            if not journal.get("structure"):
+                if stream_structure:
+                    # 流式解析：每个段落一生成就开始研究，不必等整个报告结构生成完
+                    indices = announce_paragraphs(state, itertools.chain(
+                        range(len(state.paragraphs)), report_structure_node.stream_mutate_state(state)), log)
+                else:
+                    _ = report_structure_node.mutate_state(state)
+            if indices is None:
+                log(f"总段落数: {len(state.paragraphs)}")
+                indices = announce_paragraphs(state, range(len(state.paragraphs)), log)
+
+            # Step 2: 并发执行每个段落的搜索和反思（段落之间互不依赖）
+            nodes = (first_search_node, first_summary_node, reflection_node, reflection_summary_node)
+            _ = research_paragraphs(state, nodes, max_workers=max_workers, deduplicator=SearchDeduplicator(), log=log,
+                                    section_formatting_node=section_formatting_node, indices=indices)
+
+            # Step 3: 流式生成最终报告，边生成边输出并写入文件
+            log("\n=============== 最终报告 ===============\n")
+            filename = filename or f"reports/report_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.md"
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            with open(filename, "w", encoding="utf-8") as f:
+                for chunk in report_chunks(state, report_formatting_node, report_outline_node):
+                    log(chunk, end="", flush=True)
+                    f.write(chunk)
+                    f.flush()
+            journal.append("report", path=filename)
+            log(f"\n\n报告已保存至: {filename}")
+    finally:
+        export_trace(journal, log)
+    return filename
+
+def read_topics(path, log=print):
+    """读取批量主题：每行一个主题，或每行一个含 topic 字段的 JSON 对象；path 为 - 时读标准输入
+
+    无法解析或缺少 topic 字段的行记录到 log 后跳过，不影响其他主题"""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        topics = []
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if not line.startswith("{"):
+                topics.append(line)
+                continue
+            try:
+                topic = json.loads(line).get("topic")
+            except json.JSONDecodeError as e:
+                log(f"[跳过] 第 {line_no} 行不是有效的 JSON 对象: {e}")
+                continue
+            if not isinstance(topic, str) or not topic.strip():
+                log(f"[跳过] 第 {line_no} 行缺少有效的 topic 字段")
+                continue
+            topics.append(topic.strip())
+        return topics
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run_batch(topics, llm_client, batch_workers=BATCH_WORKERS, max_workers=MAX_CONCURRENT_PARAGRAPHS, output_dir=None,
+              formatting_mode=REPORT_FORMATTING_MODE):
+    """用有界线程池批量研究多个主题，共享 LLM 和搜索客户端
+
+    每完成一个主题就写出报告，并向 manifest.jsonl 追加一行状态和耗时记录。"""
+    output_dir = output_dir or f"reports/batch_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, "manifest.jsonl")
+    manifest_lock = threading.Lock()
+
+    def run(index, topic):
+        started_at = datetime.now().isoformat(timespec="seconds")
+        start = time.perf_counter()
+        entry = {"index": index, "topic": topic, "run_id": Journal.new_run_id(), "started_at": started_at}
+        try:
+            filename = os.path.join(output_dir, f"report_{index:04d}.md")
+            run_research(topic, llm_client, max_workers=max_workers, filename=filename, run_id=entry["run_id"], log=quiet,
+                         formatting_mode=formatting_mode)
+            entry.update(status="ok", report=filename)
+        except Exception as e:
+            entry.update(status="error", error=f"{type(e).__name__}: {e}")
+        entry["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+        with manifest_lock:
+            with open(manifest_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            print(f"[{entry['status']}] {index + 1}/{len(topics)} {topic}（{entry['elapsed_seconds']}s）")
+        return entry
+
+    with ThreadPoolExecutor(max_workers=batch_workers) as executor:
+        entries = list(executor.map(run, range(len(topics)), topics))
+    print(f"\n完成 {sum(e['status'] == 'ok' for e in entries)}/{len(entries)} 个主题，清单: {manifest_path}")
+    return entries
+
+def main(topic: str = QUERY, max_workers: int = MAX_CONCURRENT_PARAGRAPHS, resume: str = None,
+         formatting_mode: str = REPORT_FORMATTING_MODE):
+    # 初始化LLM客户端
+    # 配置了多个服务商的 API Key 时按延迟和健康状况自动路由（见 router.py）
+    llm_client = with_llm_cache(create_llm_client())
+    run_research(topic, llm_client, state=STATE, max_workers=max_workers, resume=resume, formatting_mode=formatting_mode)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Deep Search Agent")
     parser.add_argument("--topic", type=str, default=QUERY, help="研究主题")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_PARAGRAPHS, help="同时研究的最大段落数（1 为串行）")
+    parser.add_argument("--resume", type=str, default=None, help="从中断的运行继续（运行 ID）")
+    parser.add_argument("--batch", type=str, default=None, help="批量研究的主题文件（每行一个主题或 JSONL），- 表示标准输入")
+    parser.add_argument("--batch-workers", type=int, default=BATCH_WORKERS, help="批量模式下同时研究的主题数")
+    parser.add_argument("--formatting", choices=["single", "map_reduce"], default=REPORT_FORMATTING_MODE,
+                        help="报告格式化方式：single 一次生成整篇报告，map_reduce 逐段格式化后只生成标题、引言和结论")
+    parser.add_argument("--trace", action="store_true", help="记录 LLM 和搜索调用并导出到运行目录的 trace.json")
     args = parser.parse_args()
-    main(args.topic)
\ No newline at end of file
+    if args.trace:
+        enable_tracing()
+    if args.batch:
+        run_batch(read_topics(args.batch), with_llm_cache(create_llm_client()),
+                  batch_workers=args.batch_workers, max_workers=args.workers, formatting_mode=args.formatting)
+    else:
+        main(args.topic, args.workers, args.resume, args.formatting)
@@ -0,0 +1,358 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import mock
+
+import agent
+import nodes
+import tools
+from convergence import ConvergencePolicy
+from hedging import Hedger
+from journal import Journal
+from llms import BaseLLM, HedgedLLM
+from prompts import (SYSTEM_PROMPT_REPORT_STRUCTURE, SYSTEM_PROMPT_FIRST_SEARCH, SYSTEM_PROMPT_FIRST_SUMMARY,
+                     SYSTEM_PROMPT_REFLECTION, SYSTEM_PROMPT_REFLECTION_MULTI, SYSTEM_PROMPT_REFLECTION_SUMMARY,
+                     SYSTEM_PROMPT_REFLECTION_SUMMARY_DELTA, SYSTEM_PROMPT_REPORT_FORMATTING, SYSTEM_PROMPT_SECTION_FORMATTING, SYSTEM_PROMPT_REPORT_OUTLINE)
+
+# 离线基准测试：用模拟的 LLM 和搜索后端驱动真实的 agent.run_research 流程，不消耗任何 API 配额
+
+STAGES = {
+    SYSTEM_PROMPT_REPORT_STRUCTURE: "report_structure",
+    SYSTEM_PROMPT_FIRST_SEARCH: "first_search",
+    SYSTEM_PROMPT_FIRST_SUMMARY: "first_summary",
+    SYSTEM_PROMPT_REFLECTION: "reflection",
+    SYSTEM_PROMPT_REFLECTION_MULTI: "reflection_multi",
+    SYSTEM_PROMPT_REFLECTION_SUMMARY: "reflection_summary",
+    SYSTEM_PROMPT_REFLECTION_SUMMARY_DELTA: "reflection_summary_delta",
+    SYSTEM_PROMPT_REPORT_FORMATTING: "report_formatting",
+    SYSTEM_PROMPT_SECTION_FORMATTING: "section_formatting",
+    SYSTEM_PROMPT_REPORT_OUTLINE: "report_outline",
+}
+
+FILLER = "模拟的研究内容，用于基准测试。Simulated research content for benchmarking. "
+VOCABULARY = [f"词{i}" for i in range(500)] + [f"term{i}" for i in range(500)]
+STREAM_CHUNK_CHARS = 20  # 模拟流式输出时每个片段的字符数
+
+
+class Latency:
+    """模拟延迟分布：对数正态分布，median 为中位数（秒），sigma 控制长尾"""
+
+    def __init__(self, median, sigma=0.5, rng=None):
+        self.median = median
+        self.sigma = sigma
+        self.rng = rng or random.Random()
+
+    def sample(self):
+        if self.median <= 0:
+            return 0.0
+        return self.median * self.rng.lognormvariate(0, self.sigma)
+
+
+class Recorder:
+    """线程安全地记录每个阶段每次调用的耗时和错误"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, error=False):
+        with self._lock:
+            self.latencies[stage].append(seconds)
+            if error:
+                self.errors[stage] += 1
+
+
+def simulate(stage, latency, error_rate, recorder, rng):
+    """按分布休眠，并按错误率抛出异常"""
+    start = time.perf_counter()
+    time.sleep(latency.sample())
+    failed = rng.random() < error_rate
+    recorder.record(stage, time.perf_counter() - start, error=failed)
+    if failed:
+        raise RuntimeError(f"simulated {stage} error")
+
+
+class FakeLLM(BaseLLM):
+    """按系统提示词识别节点并返回格式正确的模拟响应"""
+
+    def __init__(self, recorder, latency, error_rate=0.0, num_paragraphs=5, summary_chars=1500,
+                 report_chars=6000, seed=None):
+        self.recorder = recorder
+        self.latency = latency
+        self.error_rate = error_rate
+        self.num_paragraphs = num_paragraphs
+        self.summary_chars = summary_chars
+        self.report_chars = report_chars
+        self.default_model_type = "fake"
+        self.rng = random.Random(seed)
+
+    def _text(self, chars):
+        return (FILLER * (chars // len(FILLER) + 1))[:chars]
+
+    def _summary(self, chars):
+        # 每次总结内容都不同，避免被提前结束策略当作已收敛
+        return " ".join(self.rng.choices(VOCABULARY, k=chars // 5))[:chars]
+
+    def invoke(self, system_prompt: str, user_prompt: str) -> str:
+        stage = STAGES.get(system_prompt, "other")
+        simulate(stage, self.latency, self.error_rate, self.recorder, self.rng)
+        return self._respond(stage, user_prompt)
+
+    def stream(self, system_prompt: str, user_prompt: str):
+        """模拟流式输出：抽样得到的总延迟平均分摊到各个片段之前"""
+        stage = STAGES.get(system_prompt, "other")
+        response = self._respond(stage, user_prompt)
+        pieces = [response[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(response), STREAM_CHUNK_CHARS)] or [""]
+        start, seconds = time.perf_counter(), self.latency.sample()
+        failed = self.rng.random() < self.error_rate
+        for piece in pieces:
+            time.sleep(seconds / len(pieces))
+            if failed:
+                self.recorder.record(stage, time.perf_counter() - start, error=True)
+                raise RuntimeError(f"simulated {stage} error")
+            yield piece
+        self.recorder.record(stage, time.perf_counter() - start)
+
+    def _respond(self, stage, user_prompt):
+        if stage == "report_structure":
+            return json.dumps([{"title": f"段落 {i + 1}", "content": f"{user_prompt} 的第 {i + 1} 部分"}
+                               for i in range(self.num_paragraphs)], ensure_ascii=False)
+        if stage in ("first_search", "reflection"):
+            return json.dumps({"search_query": f"query {self.rng.randrange(10 ** 6)}", "reasoning": "simulated"})
+        if stage == "reflection_multi":
+            max_queries = json.loads(user_prompt).get("max_queries", 1)
+            return json.dumps({"search_queries": [f"query {self.rng.randrange(10 ** 6)}" for _ in range(max_queries)],
+                               "reasoning": "simulated"})
+        if stage == "first_summary":
+            return json.dumps({"paragraph_latest_state": self._summary(self.summary_chars)}, ensure_ascii=False)
+        if stage == "reflection_summary":
+            return json.dumps({"updated_paragraph_latest_state": self._summary(self.summary_chars)}, ensure_ascii=False)
+        if stage == "reflection_summary_delta":
+            # 每轮只返回约四分之一段落长度的新信息
+            return json.dumps({"edits": [], "additions": [{"text": self._summary(self.summary_chars // 4)}]},
+                              ensure_ascii=False)
+        if stage == "section_formatting":
+            return f"## {json.loads(user_prompt)['title']}\n\n" + self._text(self.report_chars // self.num_paragraphs)
+        if stage == "report_outline":
+            sections = json.loads(user_prompt)
+            return json.dumps({"report_title": "模拟报告", "introduction": self._text(300), "conclusion": self._text(300),
+                               "section_order": [s["index"] for s in sections]}, ensure_ascii=False)
+        return "# 模拟报告\n\n" + self._text(self.report_chars)
+
+
+class FakeSearch:
+    """与 tools.tavily_search 签名一致的模拟搜索"""
+
+    def __init__(self, recorder, latency, error_rate=0.0, content_chars=8000, seed=None):
+        self.recorder = recorder
+        self.latency = latency
+        self.error_rate = error_rate
+        self.content_chars = content_chars
+        self.rng = random.Random(seed)
+
+    def _page(self):
+        # 随机词组成的正文，避免被去重阶段当作重复内容
+        words = self.rng.choices(VOCABULARY, k=self.content_chars // 5)
+        lines = [" ".join(words[i:i + 20]) for i in range(0, len(words), 20)]
+        return "\n".join(lines)[:self.content_chars]
+
+    def __call__(self, query, include_raw_content=True, max_results=5):
+        simulate("search", self.latency, self.error_rate, self.recorder, self.rng)
+        return [{
+            "title": f"{query} #{i}",
+            "url": f"https://example.com/{self.rng.randrange(10 ** 9)}",
+            "content": f"{query}\n{self._page()}",
+        } for i in range(max_results)]
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(pick(0.50), 4),
+        "p90": round(pick(0.90), 4),
+        "p99": round(pick(0.99), 4),
+        "max": round(values[-1], 4),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run_benchmark(args):
+    """运行一次基准测试并返回结果字典"""
+    recorder = Recorder()
+    llm = FakeLLM(recorder, Latency(args.llm_latency, args.sigma), args.llm_error_rate, args.paragraphs,
+                  args.summary_chars, seed=args.seed)
+    search = FakeSearch(recorder, Latency(args.search_latency, args.sigma), args.search_error_rate,
+                        args.content_chars, seed=args.seed)
+    hedger = None
+    if args.hedging:
+        # 每次基准测试用独立的对冲器，耗时样本不受之前运行的影响；LLM 和搜索都经过对冲
+        hedger = Hedger(enabled=True)
+        llm = HedgedLLM(llm, hedger, deadline=0)
+        fake_search = search
+        search = lambda query, include_raw_content=True, max_results=5: hedger.call(
+            "tavily_search", lambda: fake_search(query, include_raw_content, max_results))
+    topics = [f"基准主题 {i}" for i in range(args.topics)]
+    topic_latencies, failures = [], 0
+
+    def run(index):
+        start = time.perf_counter()
+        try:
+            agent.run_research(topics[index], llm, max_workers=args.workers,
+                               filename=os.path.join("reports", f"report_{index:04d}.md"), log=agent.quiet,
+                               formatting_mode=args.formatting, stream_structure=not args.no_stream_structure)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, e
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, mock.patch.object(tools, "tavily_search", search), \
+            mock.patch.object(nodes, "REFLECTION_MAX_QUERIES", args.queries), \
+            mock.patch.object(nodes, "REFLECTION_SUMMARY_MODE", args.summary_mode), \
+            mock.patch.object(agent, "NUM_REFLECTIONS", args.reflections):
+        os.chdir(tmp)  # 报告和运行日志写到临时目录
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                for seconds, error in executor.map(run, range(len(topics))):
+                    topic_latencies.append(seconds)
+                    failures += error is not None
+            wall_time = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": vars(args),
+        "wall_time_s": round(wall_time, 4),
+        "topics": len(topics),
+        "failed_topics": failures,
+        "throughput_topics_per_min": round(len(topics) / wall_time * 60, 2) if wall_time else None,
+        "topic_latency_s": percentiles(topic_latencies),
+        "stages": {stage: {**percentiles(values), "errors": recorder.errors[stage]}
+                   for stage, values in sorted(recorder.latencies.items())},
+        "hedging": hedger.stats() if hedger is not None else None,
+    }
+
+
+def check_resume():
+    """回归检查：反思轮次因去重后没有新结果而跳过总结时，--resume 不应重新调用反思总结，日志中的总结事件数也不变"""
+    recorder = Recorder()
+    llm = FakeLLM(recorder, Latency(0), num_paragraphs=1, seed=0)
+    urls = iter(["https://example.com/a", "https://example.com/a", "https://example.com/b"])  # 第 1 轮反思的结果重复
+
+    def search_many(queries, max_results=5, keep=None, **kwargs):
+        results = [{"title": "t", "url": next(urls), "content": " ".join(random.choices(VOCABULARY, k=200))}]
+        return keep(results) if keep else results
+
+    def summary_events(run_id):
+        with open(Journal(run_id).path, encoding="utf-8") as f:
+            return sum(json.loads(line)["op"] == "summary" for line in f)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, mock.patch.object(agent, "search_many", search_many), \
+            mock.patch.object(agent, "ConvergencePolicy", lambda: ConvergencePolicy(enabled=False)), \
+            mock.patch.object(nodes, "REFLECTION_MAX_QUERIES", 1), \
+            mock.patch.object(nodes, "REFLECTION_SUMMARY_MODE", "full"), \
+            mock.patch.object(agent, "NUM_REFLECTIONS", 2):
+        os.chdir(tmp)
+        try:
+            run_id = Journal.new_run_id()
+            agent.run_research("恢复检查", llm, max_workers=1, run_id=run_id, log=agent.quiet, formatting_mode="single")
+            calls, events = len(recorder.latencies["reflection_summary"]), summary_events(run_id)
+            agent.run_research("恢复检查", llm, max_workers=1, resume=run_id, log=agent.quiet, formatting_mode="single")
+            assert len(recorder.latencies["reflection_summary"]) == calls, recorder.latencies["reflection_summary"]
+            assert summary_events(run_id) == events == 3, (summary_events(run_id), events)
+        finally:
+            os.chdir(cwd)
+    print(f"ok: 反思总结 {calls} 次，总结事件 {events} 条，恢复后不变")
+
+
+def compare(result, baseline):
+    """打印与基线结果的主要指标对比"""
+    print(f"\n与基线 {baseline.get('commit') or ''}（{baseline.get('timestamp')}）对比:")
+    rows = [("wall_time_s", result["wall_time_s"], baseline["wall_time_s"]),
+            ("throughput_topics_per_min", result["throughput_topics_per_min"], baseline["throughput_topics_per_min"]),
+            ("topic_latency_p50", result["topic_latency_s"].get("p50"), baseline["topic_latency_s"].get("p50")),
+            ("topic_latency_p99", result["topic_latency_s"].get("p99"), baseline["topic_latency_s"].get("p99"))]
+    for stage in result["stages"]:
+        if stage in baseline.get("stages", {}):
+            rows.append((f"{stage}.count", result["stages"][stage]["count"], baseline["stages"][stage]["count"]))
+    for name, new, old in rows:
+        change = f"{(new - old) / old * 100:+.1f}%" if new is not None and old else "n/a"
+        print(f"  {name:<32} {old!s:>10} -> {new!s:>10}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线基准测试（模拟 LLM 与搜索后端）")
+    parser.add_argument("--topics", type=int, default=8, help="研究主题数")
+    parser.add_argument("--concurrency", type=int, default=2, help="同时研究的主题数")
+    parser.add_argument("--workers", type=int, default=agent.MAX_CONCURRENT_PARAGRAPHS, help="每个主题同时研究的段落数")
+    parser.add_argument("--paragraphs", type=int, default=5, help="每个报告的段落数")
+    parser.add_argument("--reflections", type=int, default=agent.NUM_REFLECTIONS, help="每个段落的反思轮次数")
+    parser.add_argument("--queries", type=int, default=nodes.REFLECTION_MAX_QUERIES, help="每轮反思最多生成的查询数")
+    parser.add_argument("--formatting", choices=["single", "map_reduce"], default=agent.REPORT_FORMATTING_MODE,
+                        help="报告格式化方式")
+    parser.add_argument("--summary-mode", choices=["full", "delta"], default=nodes.REFLECTION_SUMMARY_MODE,
+                        help="反思总结方式：full 每轮重写整个段落，delta 只返回修改和新增内容")
+    parser.add_argument("--no-stream-structure", action="store_true", help="等待完整的报告结构后再开始研究段落")
+    parser.add_argument("--hedging", action="store_true", help="LLM 和搜索调用启用对冲请求")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="LLM 调用延迟中位数（秒）")
+    parser.add_argument("--search-latency", type=float, default=0.03, help="搜索调用延迟中位数（秒）")
+    parser.add_argument("--sigma", type=float, default=0.5, help="对数正态延迟分布的 sigma，越大长尾越重")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="LLM 调用失败率")
+    parser.add_argument("--search-error-rate", type=float, default=0.0, help="搜索调用失败率")
+    parser.add_argument("--summary-chars", type=int, default=1500, help="模拟总结长度（字符）")
+    parser.add_argument("--content-chars", type=int, default=8000, help="模拟搜索结果正文长度（字符）")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--output", type=str, default=None, help="结果 JSON 路径（默认 benchmarks/bench_<时间>.json）")
+    parser.add_argument("--compare", type=str, default=None, help="与之对比的基线结果 JSON")
+    parser.add_argument("--check-resume", action="store_true", help="只运行恢复（--resume）的回归检查")
+    args = parser.parse_args()
+
+    if args.check_resume:
+        check_resume()
+        return
+    result = run_benchmark(args)
+
+    print(f"主题数: {result['topics']}（失败 {result['failed_topics']}），总耗时 {result['wall_time_s']}s，"
+          f"吞吐 {result['throughput_topics_per_min']} 主题/分钟")
+    print(f"单主题耗时: {result['topic_latency_s']}")
+    for stage, stats in result["stages"].items():
+        print(f"  {stage:<20} {stats}")
+    for key, stats in (result["hedging"] or {}).items():
+        print(f"  对冲 {key:<30} {stats}")
+
+    output = args.output or f"benchmarks/bench_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存至: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(result, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from config import BLOB_STORE_DIR, BLOB_STORE_MAX_AGE
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """按内容寻址的磁盘存储：文本以 sha256 为键写入 root/<前两位>/<其余位>，相同内容只存一份
+
+    写入后文件内容不再修改，可被多个进程同时读写。再次写入相同内容时只刷新文件的修改时间，
+    prune 按修改时间删除长期未写入的内容；被删除的内容读取时返回空字符串并记录警告。"""
+
+    def __init__(self, root: str, max_age: float = BLOB_STORE_MAX_AGE):
+        self.root = root
+        self.max_age = max_age  # prune 默认删除超过多少秒没有再写入的内容，0 为不清理
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def put(self, text: str) -> str:
+        """写入文本并返回其哈希；内容已存在时不再写入"""
+        text = text or ""
+        digest = self.digest(text)
+        path = self.path(digest)
+        if not text:
+            return digest
+        try:
+            os.utime(path)  # 已存在：刷新修改时间，仍在使用的内容不会被清理
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再原子改名，并发写入同一内容时读者不会看到写了一半的文件
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(text.encode("utf-8"))
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest: str) -> str:
+        """读取内容；空文本的哈希不对应任何文件，直接返回空字符串。
+        内容已被清理或删除时同样返回空字符串并记录警告，不中断研究"""
+        if digest == EMPTY_DIGEST:
+            return ""
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read().decode("utf-8")
+        except FileNotFoundError:
+            logger.warning("blob %s 不存在（可能已被清理），按空内容处理", digest)
+            return ""
+
+    def prune(self, max_age: float = None) -> int:
+        """删除超过 max_age 秒（默认为 self.max_age）没有再写入的内容以及残留的临时文件，返回删除的文件数"""
+        max_age = self.max_age if max_age is None else max_age
+        if not max_age:
+            return 0
+        cutoff, removed = time.time() - max_age, 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass  # 其他进程已删除
+        return removed
+
+    def __contains__(self, digest: str) -> bool:
+        return digest == EMPTY_DIGEST or os.path.exists(self.path(digest))
+
+
+EMPTY_DIGEST = BlobStore.digest("")
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+def get_blob_store() -> BlobStore:
+    """惰性创建全局共享的 blob 存储；创建时在后台线程中清理一次过期内容"""
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore(BLOB_STORE_DIR)
+            threading.Thread(target=_blob_store.prune, name="blob-prune", daemon=True).start()
+    return _blob_store
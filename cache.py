@@ -0,0 +1,171 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class MemoryCache:
+    """进程内的 LRU 缓存，接口与 SQLiteCache 一致，适合测试、基准和单进程重复运行"""
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()     # key -> (value, expires_at)，按访问顺序排列
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl is not None else None)
+            self._entries.move_to_end(key)
+            while self.max_entries is not None and len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+class SQLiteCache:
+    """基于 SQLite 的持久化键值缓存：单条 TTL、按最近访问时间的 LRU 淘汰，可被多个进程同时使用
+
+    读取通常只执行 SELECT，不占用写锁：条目的最近访问时间只在距上次更新超过 touch_interval 秒时才写回，
+    跨进程的命中计数先记在内存中，随下一次写入一起提交"""
+
+    def __init__(self, path: str, ttl: Optional[float] = None, max_entries: Optional[int] = None,
+                 touch_interval: float = 60):
+        self.path = path
+        self.ttl = ttl                    # 默认过期秒数，None 表示永不过期
+        self.max_entries = max_entries    # 最多保留的条目数，None 表示不限制
+        self.touch_interval = touch_interval  # LRU 访问时间的精度（秒）
+        self.hits = 0                     # 本进程内的命中/未命中次数
+        self.misses = 0
+        self._pending = {"hits": 0, "misses": 0}  # 尚未写入 counters 表的计数
+        self._lock = threading.Lock()
+        self._local = threading.local()   # sqlite3 连接不能跨线程共享，每个线程一个
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                         "expires_at REAL, last_access REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_access ON entries(last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # WAL 模式允许多进程并发读写；busy timeout 让写锁冲突时等待而不是报错
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str):
+        with self._lock:
+            self._pending[name] += 1
+            if name == "hits":
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _flush_counts(self, conn: sqlite3.Connection):
+        """把内存中的计数写入 counters 表，在已有的写事务中调用"""
+        with self._lock:
+            pending, self._pending = self._pending, {"hits": 0, "misses": 0}
+        for name, value in pending.items():
+            if value:
+                conn.execute("INSERT INTO counters (name, value) VALUES (?, ?) "
+                             "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, value))
+
+    def get(self, key: str) -> Optional[Any]:
+        """读取缓存，不存在或已过期时返回 None；过期条目留给下一次 set 清理"""
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute("SELECT value, expires_at, last_access FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            self._count("misses")
+            return None
+        self._count("hits")
+        if now - row[2] >= self.touch_interval:
+            with conn:
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                self._flush_counts(conn)
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """写入缓存，value 需可 JSON 序列化；超出容量时淘汰最久未访问的条目"""
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = now + ttl if ttl is not None else None
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                         (key, json.dumps(value, ensure_ascii=False), expires_at, now))
+            conn.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            self._flush_counts(conn)
+            if self.max_entries is not None:
+                conn.execute("DELETE FROM entries WHERE key IN ("
+                             "SELECT key FROM entries ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                             (self.max_entries,))
+
+    def delete(self, key: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM counters")
+        with self._lock:
+            self._pending = {"hits": 0, "misses": 0}
+
+    def stats(self) -> dict:
+        """返回本进程及所有进程累计的命中情况和当前条目数"""
+        with self._connect() as conn:
+            self._flush_counts(conn)
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": counters.get("hits", 0),
+            "total_misses": counters.get("misses", 0),
+            "entries": entries,
+        }
+
+
+def create_cache(backend: str, path: str = "", ttl: Optional[float] = None, max_entries: Optional[int] = None):
+    """按名称创建缓存后端："memory"、"sqlite"，空字符串表示不使用缓存"""
+    if not backend:
+        return None
+    if backend == "memory":
+        return MemoryCache(ttl=ttl, max_entries=max_entries)
+    if backend == "sqlite":
+        return SQLiteCache(path, ttl=ttl, max_entries=max_entries)
+    raise ValueError(f"Unknown cache backend: {backend}")
@@ -12,7 +12,135 @@ TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 # Custom Settings
 NUM_REFLECTIONS = int(os.getenv("NUM_REFLECTIONS", 2))
 NUM_RESULTS_PER_SEARCH = int(os.getenv("NUM_RESULTS_PER_SEARCH", 3))
-CAP_SEARCH_LENGTH = int(os.getenv("CAP_SEARCH_LENGTH", 20000))
+# 每轮反思最多生成的查询数；大于 1 时这些查询并发搜索，合并去重后只做一次总结
+REFLECTION_MAX_QUERIES = int(os.getenv("REFLECTION_MAX_QUERIES", 1))
+# 总结节点的证据预算：搜索结果按段落切分，按相关度挑选到 token 预算用完为止
+PASSAGE_MAX_CHARS = int(os.getenv("PASSAGE_MAX_CHARS", 600))
+FIRST_SUMMARY_TOKEN_BUDGET = int(os.getenv("FIRST_SUMMARY_TOKEN_BUDGET", 6000))
+REFLECTION_SUMMARY_TOKEN_BUDGET = int(os.getenv("REFLECTION_SUMMARY_TOKEN_BUDGET", 6000))
+# 反思总结方式：full 每轮重写整个段落；delta 只输出对已有文本块的修改和新增内容，在本地合并，
+# 输出长度只与新信息有关，不随段落变长而增长。DELTA_BLOCK_MAX_CHARS 为段落切分成文本块的最大长度
+REFLECTION_SUMMARY_MODE = os.getenv("REFLECTION_SUMMARY_MODE", "full")
+DELTA_BLOCK_MAX_CHARS = int(os.getenv("DELTA_BLOCK_MAX_CHARS", 300))
+MAX_CONCURRENT_PARAGRAPHS = int(os.getenv("MAX_CONCURRENT_PARAGRAPHS", 4))  # 同时研究的段落数，1 为串行
+RUNS_DIR = os.getenv("RUNS_DIR", "runs")  # 运行日志目录，用于 --resume 恢复
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 4))  # 批量模式下同时研究的主题数
+
+# 搜索结果去重：内容相似度（0~1）达到阈值即视为重复；是否跨段落去重
+DEDUP_SIMILARITY_THRESHOLD = float(os.getenv("DEDUP_SIMILARITY_THRESHOLD", 0.8))
+DEDUP_ACROSS_PARAGRAPHS = os.getenv("DEDUP_ACROSS_PARAGRAPHS", "true").lower() == "true"
+
+# 反思提前结束：查询重复、没有新的搜索结果或总结几乎不再变化时，段落不再继续反思
+EARLY_STOP_ENABLED = os.getenv("EARLY_STOP_ENABLED", "true").lower() == "true"
+EARLY_STOP_SUMMARY_SIMILARITY = float(os.getenv("EARLY_STOP_SUMMARY_SIMILARITY", 0.9))
+# 每个段落的预算（0 为不限制）：估计的 LLM 输入输出 token 数和秒数，用完后不再开始新一轮反思
+PARAGRAPH_TOKEN_BUDGET = int(os.getenv("PARAGRAPH_TOKEN_BUDGET", 0))
+PARAGRAPH_TIME_BUDGET = float(os.getenv("PARAGRAPH_TIME_BUDGET", 0))
+
+# 搜索结果缓存（SEARCH_CACHE_PATH 置空即关闭）
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", ".cache/search_cache.sqlite3")
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 86400))            # 单条缓存有效期（秒）
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 10000))  # 超出后按最近访问时间淘汰
+
+# 搜索请求：连接/读取超时（秒）及同时进行的最大请求数（也是连接池大小）
+SEARCH_CONNECT_TIMEOUT = float(os.getenv("SEARCH_CONNECT_TIMEOUT", 10))
+SEARCH_READ_TIMEOUT = float(os.getenv("SEARCH_READ_TIMEOUT", 60))
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", 8))
+
+# LLM 响应缓存：memory（进程内）、sqlite（持久化）或留空关闭
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".cache/llm_cache.sqlite3")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 86400))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 5000))
+
+# 限流：每个服务商每分钟请求数（RPM）、每分钟 token 数（TPM，按估计的输入输出 token 计）和最大并发数，0 为不限制；
+# 实际并发数在最大并发数以内按 AIMD 自动调整：成功时缓慢增加，遇到限流、超时或延迟明显升高时减半
+def _rate_limit(provider, rpm=0, tpm=0, max_concurrency=16):
+    return {
+        "rpm": float(os.getenv(f"{provider}_RPM", rpm)),
+        "tpm": float(os.getenv(f"{provider}_TPM", tpm)),
+        "max_concurrency": int(os.getenv(f"{provider}_MAX_CONCURRENCY", max_concurrency)),
+    }
+
+RATE_LIMITS = {
+    "zhipu": _rate_limit("ZHIPU"),
+    "gemini": _rate_limit("GEMINI"),
+    "tavily": _rate_limit("TAVILY", max_concurrency=SEARCH_MAX_CONCURRENCY),
+}
+# 限流、超时和服务端错误的重试：最多重试次数、指数退避的初始和最大等待秒数（有 Retry-After 时以其为准）
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", 5))
+RATE_LIMIT_BASE_DELAY = float(os.getenv("RATE_LIMIT_BASE_DELAY", 1.0))
+RATE_LIMIT_MAX_DELAY = float(os.getenv("RATE_LIMIT_MAX_DELAY", 60.0))
+# 短期平均延迟超过长期基线的倍数时视为拥塞并降低并发，0 为只按错误调整
+RATE_LIMIT_LATENCY_TOLERANCE = float(os.getenv("RATE_LIMIT_LATENCY_TOLERANCE", 3.0))
+
+# 单次请求的客户端超时（秒）；以及整个调用（含限流排队、重试和对冲）的截止时间，0 为不限时
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 180))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", 300))
+# 服务端提示词缓存：为每个节点的系统提示词创建缓存上下文（目前只有 Gemini 支持显式缓存），跨调用和段落复用
+LLM_PROMPT_CACHE = os.getenv("LLM_PROMPT_CACHE", "false").lower() == "true"
+LLM_PROMPT_CACHE_TTL = float(os.getenv("LLM_PROMPT_CACHE_TTL", 3600))   # 缓存上下文的有效期（秒）
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", 90))
+# 对冲请求：调用超过同类调用最近耗时的第 HEDGE_PERCENTILE 百分位仍未返回时再发一个相同请求，取先返回的结果；
+# 至少有 HEDGE_MIN_SAMPLES 个样本才对冲，对冲请求不超过总调用数的 HEDGE_MAX_EXTRA_LOAD 比例
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+HEDGE_MAX_EXTRA_LOAD = float(os.getenv("HEDGE_MAX_EXTRA_LOAD", 0.1))
+# 同步调用设置了截止时间或需要对冲时在共享线程池中执行，这是线程池的最大线程数
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", 64))
+
+# 多服务商路由：按顺序使用配置了 API Key 的服务商，多于一个时每次调用选择该节点延迟最低的健康服务商，失败时切换
+LLM_PROVIDERS = [p.strip() for p in os.getenv("LLM_PROVIDERS", "zhipu,gemini").split(",") if p.strip()]
+ROUTER_LATENCY_ALPHA = float(os.getenv("ROUTER_LATENCY_ALPHA", 0.2))    # 延迟和错误率 EWMA 的平滑系数
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", 0.5))  # 错误率超过该值视为不健康
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", 30))               # 不健康的服务商多久（秒）后重新尝试
+ROUTER_EXPLORE_RATE = float(os.getenv("ROUTER_EXPLORE_RATE", 0.05))     # 随机选择其他健康服务商以更新延迟统计的概率
+
+# 按节点分配模型：逗号分隔的 "服务商:模型"，如 "zhipu:glm-4-flash,gemini:gemini-2.0-flash-lite"；
+# 列出多个服务商时在它们之间路由，未列出的服务商、或留空时使用服务商的默认模型。
+# 只输出简短 JSON 查询的节点默认用小模型，总结和格式化节点默认用服务商的默认模型
+def _node_models(env, default=""):
+    spec = os.getenv(env, default)
+    return dict(item.strip().split(":", 1) for item in spec.split(",") if ":" in item)
+
+NODE_MODELS = {
+    "ReportStructureNode": _node_models("REPORT_STRUCTURE_MODEL"),
+    "FirstSearchNode": _node_models("FIRST_SEARCH_MODEL", "zhipu:glm-4-flash,gemini:gemini-2.0-flash-lite"),
+    "FirstSummaryNode": _node_models("FIRST_SUMMARY_MODEL"),
+    "ReflectionNode": _node_models("REFLECTION_MODEL", "zhipu:glm-4-flash,gemini:gemini-2.0-flash-lite"),
+    "ReflectionSummaryNode": _node_models("REFLECTION_SUMMARY_MODEL"),
+    "ReportFormattingNode": _node_models("REPORT_FORMATTING_MODEL"),
+    "SectionFormattingNode": _node_models("SECTION_FORMATTING_MODEL"),
+    "ReportOutlineNode": _node_models("REPORT_OUTLINE_MODEL"),
+}
+
+# 流式解析报告结构：每个段落的 JSON 对象一生成完就开始研究该段落，不必等整个报告结构
+STREAM_REPORT_STRUCTURE = os.getenv("STREAM_REPORT_STRUCTURE", "true").lower() == "true"
+
+# 报告格式化方式：single 为所有段落完成后一次性生成整篇报告；
+# map_reduce 为每个段落研究完成后立即并行格式化成章节，最后只撰写标题、引言、结论并确定章节顺序
+REPORT_FORMATTING_MODE = os.getenv("REPORT_FORMATTING_MODE", "single")
+
+# 搜索结果正文的磁盘存储目录：State 中只保留正文哈希，正文按内容去重存放于此
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", ".cache/blobs")
+# 超过这么多秒没有再写入的正文在进程启动时被清理（0 为不清理）；已清理的正文读取时按空内容处理
+BLOB_STORE_MAX_AGE = int(os.getenv("BLOB_STORE_MAX_AGE", 30 * 86400))
+
+# 本地语料库：所有运行抓取过的搜索结果建立 BM25 全文索引，搜索时先查本地，召回不足才调用网络搜索
+LOCAL_CORPUS_ENABLED = os.getenv("LOCAL_CORPUS_ENABLED", "true").lower() == "true"
+LOCAL_CORPUS_PATH = os.getenv("LOCAL_CORPUS_PATH", ".cache/corpus.sqlite3")
+# 本地结果至少包含查询中这个比例的词才算召回
+LOCAL_CORPUS_MIN_COVERAGE = float(os.getenv("LOCAL_CORPUS_MIN_COVERAGE", 0.8))
+# 本地结果的最长保存时间（秒），更早抓取的内容不再召回，时效性强的主题会重新搜索网络；0 为不限制
+LOCAL_CORPUS_MAX_AGE = int(os.getenv("LOCAL_CORPUS_MAX_AGE", 7 * 86400))
+
+# 追踪：记录每次 LLM 和搜索调用的节点、段落、轮次、大小、token 用量和耗时，导出到运行目录的 trace.json
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "false").lower() == "true"
+
+# 网页端后台任务：已结束的任务保留多少秒供页面读取（0 为不按时间淘汰），以及最多保留多少个
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 3600))
+JOB_MAX_FINISHED = int(os.getenv("JOB_MAX_FINISHED", 50))
 
 # 检查必要的环境变量
 def check_api_keys():
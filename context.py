@@ -0,0 +1,105 @@
+import math
+import re
+from collections import Counter
+
+from config import PASSAGE_MAX_CHARS
+
+_WORD_RE = re.compile(r"[a-z0-9]+|[一-鿿]+")
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？!?；;])|(?<=\.)\s")
+
+def tokenize(text):
+    """分词：英文和数字按单词切分，连续汉字按相邻两字（bigram）切分"""
+    tokens = []
+    for word in _WORD_RE.findall((text or "").lower()):
+        if "一" <= word[0] <= "鿿" and len(word) > 1:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+def estimate_tokens(text):
+    """粗略估计 token 数：汉字约 1 个 token，其他字符约 4 个一个 token"""
+    cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+    return cjk + (len(text) - cjk + 3) // 4
+
+def split_passages(text, max_chars=PASSAGE_MAX_CHARS):
+    """按行把正文切成不超过 max_chars 的段落，过长的行再按句子或长度切开"""
+    pieces = []
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if len(line) <= max_chars:
+            pieces.append(line)
+            continue
+        for sentence in _SENTENCE_END_RE.split(line):
+            sentence = sentence.strip()
+            pieces.extend(sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars) if sentence)
+
+    # 合并相邻的短句，避免段落过碎
+    passages, current = [], ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            passages.append(current)
+            current = piece
+        else:
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+
+class BM25:
+    """Okapi BM25 排序"""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_freqs = [Counter(tokenize(doc)) for doc in documents]
+        self.doc_lens = [sum(freqs.values()) for freqs in self.doc_freqs]
+        self.avg_len = sum(self.doc_lens) / len(self.doc_lens) if self.doc_lens else 0
+        df = Counter(token for freqs in self.doc_freqs for token in freqs)
+        n = len(documents)
+        self.idf = {token: math.log(1 + (n - f + 0.5) / (f + 0.5)) for token, f in df.items()}
+
+    def scores(self, query):
+        query_tokens = set(tokenize(query))
+        scores = []
+        for freqs, length in zip(self.doc_freqs, self.doc_lens):
+            score = 0.0
+            for token in query_tokens:
+                tf = freqs.get(token)
+                if tf:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / (self.avg_len or 1))
+                    score += self.idf[token] * tf * (self.k1 + 1) / norm
+            scores.append(score)
+        return scores
+
+
+def pack_search_results(search_results, query, token_budget):
+    """把搜索结果切成段落，按与 query 的 BM25 相关度从高到低装入 token 预算
+
+    返回值与原来的 search_results 消息字段一致：每条结果一个字符串，
+    只包含被选中的段落（保持原文顺序），没有段落入选的结果被省略。"""
+    passages = []  # (结果序号, 段落序号, 文本)
+    for i, result in enumerate(search_results):
+        for j, passage in enumerate(split_passages(result.get("content") or "")):
+            passages.append((i, j, passage))
+    if not passages:
+        return []
+
+    scores = BM25([p[2] for p in passages]).scores(query)
+    ranked = sorted(range(len(passages)), key=lambda k: (-scores[k], passages[k][0], passages[k][1]))
+
+    chosen, used = [], 0
+    for k in ranked:
+        cost = estimate_tokens(passages[k][2])
+        if used + cost > token_budget:
+            continue
+        chosen.append(passages[k])
+        used += cost
+
+    packed = {}
+    for i, j, passage in sorted(chosen):
+        packed.setdefault(i, []).append(passage)
+    return ["\n".join(packed[i]) for i in sorted(packed)]
@@ -0,0 +1,75 @@
+import time
+
+from context import estimate_tokens
+from dedup import normalize_url, content_sketch, estimate_similarity
+from tools import normalize_query
+from config import (EARLY_STOP_ENABLED, EARLY_STOP_SUMMARY_SIMILARITY, PARAGRAPH_TOKEN_BUDGET,
+                    PARAGRAPH_TIME_BUDGET)
+
+# 停止原因
+COMPLETED = "completed"                # 跑满 NUM_REFLECTIONS 轮
+REPEATED_QUERY = "repeated_query"      # 反思给出的查询都已经搜索过
+NO_NEW_RESULTS = "no_new_results"      # 搜索结果的 URL 都已在搜索记录中
+SUMMARY_CONVERGED = "summary_converged"  # 更新后的总结与之前几乎相同
+TOKEN_BUDGET = "token_budget"          # 段落的 token 预算已用完
+TIME_BUDGET = "time_budget"            # 段落的时间预算已用完
+
+# 日志中显示的停止原因说明
+STOP_REASONS = {
+    COMPLETED: "已完成全部反思轮次",
+    REPEATED_QUERY: "反思查询与之前的查询重复",
+    NO_NEW_RESULTS: "搜索没有带来新的结果",
+    SUMMARY_CONVERGED: "总结已基本不再变化",
+    TOKEN_BUDGET: "段落 token 预算已用完",
+    TIME_BUDGET: "段落时间预算已用完",
+}
+
+
+class ConvergencePolicy:
+    """判断一个段落的反思循环是否还在获得新信息，不再有收获时提前结束
+
+    每轮反思依次检查：预算是否用完、查询是否重复、搜索是否带来新的 URL、总结是否仍在变化。
+    各 check_* 方法返回停止原因，继续时返回 None；未开启时只检查预算。"""
+
+    def __init__(self, enabled=EARLY_STOP_ENABLED, summary_similarity=EARLY_STOP_SUMMARY_SIMILARITY,
+                 token_budget=PARAGRAPH_TOKEN_BUDGET, time_budget=PARAGRAPH_TIME_BUDGET):
+        self.enabled = enabled
+        self.summary_similarity = summary_similarity
+        self.token_budget = token_budget
+        self.time_budget = time_budget
+        self.tokens = 0
+        self.started = time.monotonic()
+        self._queries = set()
+        self._urls = set()
+
+    def spend(self, *texts):
+        """累计发给 LLM 和从 LLM 收到的文本的估计 token 数"""
+        self.tokens += sum(estimate_tokens(text or "") for text in texts)
+
+    def check_budget(self):
+        if self.token_budget and self.tokens >= self.token_budget:
+            return TOKEN_BUDGET
+        if self.time_budget and time.monotonic() - self.started >= self.time_budget:
+            return TIME_BUDGET
+        return None
+
+    def check_queries(self, queries):
+        """记录本轮查询；全部都搜索过时返回 REPEATED_QUERY"""
+        normalized = {normalize_query(query or "") for query in queries}
+        repeated = normalized <= self._queries
+        self._queries |= normalized
+        return REPEATED_QUERY if self.enabled and repeated else None
+
+    def check_results(self, search_results):
+        """记录本轮搜索结果；没有新的 URL 时返回 NO_NEW_RESULTS"""
+        urls = {normalize_url(result["url"]) for result in search_results}
+        fresh = urls - self._urls
+        self._urls |= urls
+        return NO_NEW_RESULTS if self.enabled and not fresh else None
+
+    def check_summary(self, before, after):
+        """总结前后的内容相似度达到阈值时返回 SUMMARY_CONVERGED"""
+        if not self.enabled or not before:
+            return None
+        similarity = estimate_similarity(content_sketch(before), content_sketch(after))
+        return SUMMARY_CONVERGED if similarity >= self.summary_similarity else None
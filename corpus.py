@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import threading
+import time
+
+from context import tokenize
+from dedup import normalize_url
+from config import LOCAL_CORPUS_ENABLED, LOCAL_CORPUS_PATH, LOCAL_CORPUS_MIN_COVERAGE, LOCAL_CORPUS_MAX_AGE
+
+
+class LocalCorpus:
+    """所有运行抓取过的搜索结果组成的本地语料库，带 BM25 全文索引，可被多个进程同时使用
+
+    正文按 context.tokenize 分词（英文单词、汉字 bigram）后写入 SQLite FTS5 倒排索引，
+    同一 URL（归一化后）只保留最新抓取的一份。"""
+
+    def __init__(self, path: str, min_coverage: float = LOCAL_CORPUS_MIN_COVERAGE, max_age: float = LOCAL_CORPUS_MAX_AGE):
+        self.path = path
+        self.min_coverage = min_coverage  # 结果至少要包含查询中这个比例的词才算召回
+        self.max_age = max_age            # 超过这个秒数的抓取结果不再召回，0 为不限制
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS documents ("
+                         "id INTEGER PRIMARY KEY, url TEXT UNIQUE NOT NULL, raw_url TEXT NOT NULL, "
+                         "title TEXT, content TEXT NOT NULL, fetched_at REAL NOT NULL)")
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS documents_index USING fts5(tokens)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, search_results):
+        """把搜索结果写入语料库；已有的 URL 用新内容覆盖"""
+        rows = [(normalize_url(r["url"]), r["url"], r.get("title", ""), r["content"])
+                for r in search_results if r.get("url") and r.get("content")]
+        if not rows:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            for url, raw_url, title, content in rows:
+                row = conn.execute("SELECT id FROM documents WHERE url = ?", (url,)).fetchone()
+                if row:
+                    conn.execute("UPDATE documents SET raw_url = ?, title = ?, content = ?, fetched_at = ? WHERE id = ?",
+                                 (raw_url, title, content, now, row[0]))
+                    conn.execute("DELETE FROM documents_index WHERE rowid = ?", (row[0],))
+                    doc_id = row[0]
+                else:
+                    doc_id = conn.execute("INSERT INTO documents (url, raw_url, title, content, fetched_at) "
+                                          "VALUES (?, ?, ?, ?, ?)", (url, raw_url, title, content, now)).lastrowid
+                conn.execute("INSERT INTO documents_index (rowid, tokens) VALUES (?, ?)",
+                             (doc_id, " ".join(tokenize(f"{title}\n{content}"))))
+
+    def search(self, query: str, max_results: int = 5):
+        """按 BM25 返回与查询最相关、覆盖足够多查询词且未过期的文档，格式与 tavily_search 的结果相同"""
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        match = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        min_fetched_at = time.time() - self.max_age if self.max_age else 0
+        rows = self._connect().execute(
+            "SELECT d.raw_url, d.title, d.content, bm25(documents_index) AS rank "
+            "FROM documents_index JOIN documents d ON d.id = documents_index.rowid "
+            "WHERE documents_index MATCH ? AND d.fetched_at >= ? ORDER BY rank LIMIT ?",
+            (match, min_fetched_at, max_results * 3)).fetchall()
+
+        results = []
+        for url, title, content, rank in rows:
+            coverage = len(set(terms) & set(tokenize(f"{title}\n{content}"))) / len(terms)
+            if coverage >= self.min_coverage:
+                results.append({"title": title, "url": url, "content": content, "score": round(-rank, 4),
+                                "source": "local"})
+            if len(results) >= max_results:
+                break
+        return results
+
+    def stats(self) -> dict:
+        count = self._connect().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        return {"documents": count, "path": self.path}
+
+
+_corpus = None
+_corpus_lock = threading.Lock()
+
+def get_local_corpus():
+    """返回全局共享的本地语料库，未开启时返回 None"""
+    global _corpus
+    if not LOCAL_CORPUS_ENABLED:
+        return None
+    with _corpus_lock:
+        if _corpus is None:
+            _corpus = LocalCorpus(LOCAL_CORPUS_PATH)
+    return _corpus
@@ -0,0 +1,91 @@
+import heapq
+import re
+import threading
+import zlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from config import DEDUP_SIMILARITY_THRESHOLD, DEDUP_ACROSS_PARAGRAPHS
+
+# 跟踪参数不影响页面内容，归一化 URL 时去掉
+TRACKING_PARAMS = {"utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content", "spm", "from", "ref"}
+
+def normalize_url(url):
+    """归一化 URL：忽略协议、大小写、www、片段、跟踪参数和结尾斜杠"""
+    parts = urlsplit((url or "").strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query) if k.lower() not in TRACKING_PARAMS))
+    return urlunsplit(("", host, parts.path.rstrip("/"), query, ""))
+
+def content_sketch(text, shingle_size=5, k=128):
+    """MinHash（bottom-k）签名：取文本所有字符 shingle 哈希值中最小的 k 个
+
+    按字符切分 shingle 对中文同样有效；两份签名即可估计原文的 Jaccard 相似度"""
+    text = re.sub(r"\s+", " ", (text or "").lower()).strip()
+    if len(text) <= shingle_size:
+        shingles = {text} if text else set()
+    else:
+        shingles = {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+    return frozenset(heapq.nsmallest(k, {zlib.crc32(s.encode("utf-8")) for s in shingles}))
+
+def estimate_similarity(a, b, k=128):
+    """用两份 bottom-k 签名估计 Jaccard 相似度"""
+    if not a or not b:
+        return 0.0
+    union = heapq.nsmallest(k, a | b)
+    return sum(1 for h in union if h in a and h in b) / len(union)
+
+
+class SearchDeduplicator:
+    """一次研究运行内的搜索结果去重器，记录已出现的 URL 和内容签名
+
+    同一段落中再次出现的结果（相同 URL 或内容近似重复）会被丢弃；
+    across_paragraphs 为 True 时，其他段落已经用过的结果也会被丢弃。
+
+    注意跨段落去重与段落并发一起使用时结果不确定：多个段落搜到同一结果时，归属于先完成搜索的段落，
+    每次运行可能不同。需要可复现的输出时关闭跨段落去重，或把 MAX_CONCURRENT_PARAGRAPHS 设为 1。"""
+
+    def __init__(self, threshold=DEDUP_SIMILARITY_THRESHOLD, across_paragraphs=DEDUP_ACROSS_PARAGRAPHS):
+        self.threshold = threshold
+        self.across_paragraphs = across_paragraphs
+        self._urls = set()     # (范围, 归一化 URL)，范围为段落序号，跨段落去重时为 None
+        self._sketches = []    # (签名, 段落)
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def _scope(self, idx_paragraph):
+        return None if self.across_paragraphs else idx_paragraph
+
+    def _is_duplicate(self, url, sketch, idx_paragraph):
+        if (self._scope(idx_paragraph), url) in self._urls:
+            return True
+        return any(
+            (self.across_paragraphs or idx == idx_paragraph) and estimate_similarity(sketch, other) >= self.threshold
+            for other, idx in self._sketches
+        )
+
+    def _add(self, url, sketch, idx_paragraph):
+        self._urls.add((self._scope(idx_paragraph), url))
+        if sketch:
+            self._sketches.append((sketch, idx_paragraph))
+
+    def filter(self, search_results, idx_paragraph):
+        """返回去掉重复项后的搜索结果，并记住保留下来的结果"""
+        kept = []
+        with self._lock:
+            for result in search_results:
+                url = normalize_url(result["url"])
+                sketch = content_sketch(result["content"])
+                if self._is_duplicate(url, sketch, idx_paragraph):
+                    self.dropped += 1
+                    continue
+                self._add(url, sketch, idx_paragraph)
+                kept.append(result)
+        return kept
+
+    def register(self, search_results, idx_paragraph):
+        """只记录不过滤，用于恢复运行时登记日志中已有的结果"""
+        with self._lock:
+            for result in search_results:
+                self._add(normalize_url(result["url"]), content_sketch(result["content"]), idx_paragraph)
@@ -0,0 +1,230 @@
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from tracing import record_usage
+from config import HEDGING_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_MAX_EXTRA_LOAD, HEDGE_MAX_WORKERS
+
+
+class DeadlineExceeded(TimeoutError):
+    """调用在截止时间内没有返回"""
+
+
+class LatencyTracker:
+    """记录某类调用最近 window 次的耗时，用于计算对冲阈值"""
+
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self._lock:
+            self.samples.append(latency)
+
+    def percentile(self, p: float, min_samples: int = 1):
+        """第 p 百分位的耗时；样本不足 min_samples 时返回 None"""
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class WorkerPool:
+    """最多 max_workers 个守护线程的共享线程池，线程按需创建并复用
+
+    与 ThreadPoolExecutor 不同，工作线程是守护线程，进程退出时不会等待落后的请求跑完；
+    所有线程都忙时任务排队等待空闲线程。"""
+
+    def __init__(self, max_workers: int = HEDGE_MAX_WORKERS, name: str = "hedge"):
+        self.max_workers = max_workers
+        self.name = name
+        self.tasks = queue.SimpleQueue()
+        self.threads = 0
+        self.idle = 0       # 没有在执行任务的线程数（包括刚创建、还没取任务的）
+        self.pending = 0    # 已提交、还没被线程取走的任务数
+        self._lock = threading.Lock()
+
+    def submit(self, task):
+        with self._lock:
+            # 排队的任务数超过空闲线程数时才新建线程，同时到达的一批任务不会挤在同一个空闲线程后面
+            self.pending += 1
+            if self.pending > self.idle and self.threads < self.max_workers:
+                self.threads += 1
+                self.idle += 1
+                threading.Thread(target=self._work, name=f"{self.name}-{self.threads}", daemon=True).start()
+        self.tasks.put(task)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            with self._lock:
+                self.idle -= 1
+                self.pending -= 1
+            try:
+                task()
+            finally:
+                with self._lock:
+                    self.idle += 1
+
+
+class Hedger:
+    """对冲请求：调用超过同类调用最近耗时的第 percentile 百分位仍未返回时，再发一个相同的请求，取先返回的结果
+
+    只用于幂等调用（LLM 生成、搜索）。对冲请求数不超过总调用数的 max_extra_load 比例；
+    deadline 为整个调用（包括对冲）的截止时间，超时抛出 DeadlineExceeded。
+    同步调用在共享的 WorkerPool 中执行，落后请求无法中断，会跑完（受客户端自身超时限制）后丢弃结果；异步调用会被取消。"""
+
+    def __init__(self, percentile: float = HEDGE_PERCENTILE, min_samples: int = HEDGE_MIN_SAMPLES,
+                 max_extra_load: float = HEDGE_MAX_EXTRA_LOAD, enabled: bool = HEDGING_ENABLED,
+                 max_workers: int = HEDGE_MAX_WORKERS):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_extra_load = max_extra_load
+        self.enabled = enabled
+        self.workers = WorkerPool(max_workers)
+        self.trackers = defaultdict(LatencyTracker)
+        self.counts = defaultdict(lambda: {"calls": 0, "hedged": 0, "hedge_wins": 0, "deadline_exceeded": 0})
+        self._lock = threading.Lock()
+
+    def _count(self, key, name):
+        with self._lock:
+            self.counts[key][name] += 1
+
+    def hedge_delay(self, key):
+        """key 类调用的对冲等待时间；未开启或样本不足时返回 None"""
+        if not self.enabled or not self.max_extra_load:
+            return None
+        return self.trackers[key].percentile(self.percentile, self.min_samples)
+
+    def _allow_hedge(self, key) -> bool:
+        """额外负载上限：所有调用中已发出的对冲请求比例不超过 max_extra_load"""
+        with self._lock:
+            calls = sum(c["calls"] for c in self.counts.values())
+            hedged = sum(c["hedged"] for c in self.counts.values())
+            if hedged + 1 > self.max_extra_load * calls:
+                return False
+            self.counts[key]["hedged"] += 1
+            return True
+
+    def _start(self, key, fn) -> Future:
+        """在共享线程池中执行 fn（继承当前的追踪上下文），完成时记录耗时"""
+        future, ctx, start = Future(), contextvars.copy_context(), time.monotonic()
+
+        def run():
+            try:
+                result = ctx.run(fn)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                self.trackers[key].add(time.monotonic() - start)
+                future.set_result(result)
+
+        self.workers.submit(run)
+        return future
+
+    def _timeout(self, key, deadline):
+        self._count(key, "deadline_exceeded")
+        return DeadlineExceeded(f"{key} 在 {deadline:g} 秒内没有返回")
+
+    def call(self, key: str, fn, deadline: float = 0):
+        """执行 fn()，必要时对冲；deadline 为 0 时不限时"""
+        self._count(key, "calls")
+        delay = self.hedge_delay(key)
+        if delay is None and not deadline:
+            start = time.monotonic()
+            result = fn()  # 无需对冲也不限时，直接在当前线程执行
+            self.trackers[key].add(time.monotonic() - start)
+            return result
+
+        end = time.monotonic() + deadline if deadline else None
+        remaining = lambda: None if end is None else max(0.0, end - time.monotonic())
+        primary = self._start(key, fn)
+        attempts = [primary]
+        first_wait = delay if end is None else min(delay if delay is not None else deadline, remaining())
+        wait(attempts, timeout=first_wait)
+        if not primary.done() and delay is not None and (end is None or remaining() > 0) and self._allow_hedge(key):
+            attempts.append(self._start(key, fn))
+            record_usage(hedged=1)
+
+        pending, error = set(attempts), None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise self._timeout(key, deadline)
+            for attempt in done:
+                if attempt.exception() is None:
+                    if attempt is not primary:
+                        self._count(key, "hedge_wins")
+                        record_usage(hedge_won=1)
+                    return attempt.result()
+                error = error or attempt.exception()
+        raise error
+
+    async def acall(self, key: str, fn, deadline: float = 0):
+        """call 的异步版本，fn() 返回协程；落后的请求会被取消"""
+        self._count(key, "calls")
+        end = time.monotonic() + deadline if deadline else None
+        remaining = lambda: None if end is None else max(0.0, end - time.monotonic())
+
+        async def timed():
+            start = time.monotonic()
+            result = await fn()
+            self.trackers[key].add(time.monotonic() - start)
+            return result
+
+        primary = asyncio.ensure_future(timed())
+        attempts = {primary}
+        try:
+            delay = self.hedge_delay(key)
+            first_wait = delay if end is None else min(delay if delay is not None else deadline, remaining())
+            await asyncio.wait(attempts, timeout=first_wait)
+            if not primary.done() and delay is not None and (end is None or remaining() > 0) and self._allow_hedge(key):
+                attempts.add(asyncio.ensure_future(timed()))
+                record_usage(hedged=1)
+
+            pending, error = set(attempts), None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise self._timeout(key, deadline)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not primary:
+                            self._count(key, "hedge_wins")
+                            record_usage(hedge_won=1)
+                        return attempt.result()
+                    error = error or attempt.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def stats(self) -> dict:
+        """每类调用的次数、对冲次数、对冲胜出次数、超时次数和当前对冲阈值"""
+        with self._lock:
+            counts = {key: dict(c) for key, c in self.counts.items()}
+        for key, c in counts.items():
+            threshold = self.hedge_delay(key)
+            c["hedge_after"] = round(threshold, 3) if threshold is not None else None
+            c["hedge_win_rate"] = round(c["hedge_wins"] / c["hedged"], 3) if c["hedged"] else None
+        return counts
+
+
+_hedger = None
+_hedger_lock = threading.Lock()
+
+def get_hedger() -> Hedger:
+    """惰性创建全局共享的对冲器"""
+    global _hedger
+    with _hedger_lock:
+        if _hedger is None:
+            _hedger = Hedger()
+    return _hedger
+
+def hedge_stats() -> dict:
+    return get_hedger().stats()
@@ -0,0 +1,181 @@
+import threading
+import time
+import traceback
+
+from agent import run_research
+from journal import Journal
+from llms import BaseLLM
+from state import State
+from config import JOB_RETENTION, JOB_MAX_FINISHED
+
+
+class JobCancelled(Exception):
+    """任务已被取消，在研究的下一次 LLM 调用或进度输出时抛出以结束后台线程"""
+
+
+class CancellableLLM(BaseLLM):
+    """每次调用前检查任务是否已取消；已在进行的调用会正常完成，之后的调用直接抛出 JobCancelled"""
+
+    def __init__(self, llm: BaseLLM, cancelled: threading.Event):
+        self.llm = llm
+        self.cancelled = cancelled
+        self.default_model_type = getattr(llm, "default_model_type", "")
+
+    def _check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    def with_models(self, models: dict) -> BaseLLM:
+        return CancellableLLM(self.llm.with_models(models), self.cancelled)
+
+    def without_cache(self) -> BaseLLM:
+        return CancellableLLM(self.llm.without_cache(), self.cancelled)
+
+    def invoke(self, system_prompt: str, user_prompt: str) -> str:
+        self._check()
+        return self.llm.invoke(system_prompt, user_prompt)
+
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        self._check()
+        return await self.llm.ainvoke(system_prompt, user_prompt)
+
+    def stream(self, system_prompt: str, user_prompt: str):
+        self._check()
+        for chunk in self.llm.stream(system_prompt, user_prompt):
+            self._check()
+            yield chunk
+
+    async def astream(self, system_prompt: str, user_prompt: str):
+        self._check()
+        async for chunk in self.llm.astream(system_prompt, user_prompt):
+            self._check()
+            yield chunk
+
+
+class ResearchJob:
+    """在后台线程中执行一次完整研究（agent.run_research），记录进度事件供界面轮询
+
+    state 在研究过程中被逐步填充，界面随时可以读取它渲染已完成的部分；
+    report 在最终报告流式生成时逐段追加。"""
+
+    def __init__(self, topic: str, llm_client, **options):
+        self.topic = topic
+        self._cancelled = threading.Event()
+        self.llm_client = CancellableLLM(llm_client, self._cancelled)
+        self.options = options          # 透传给 run_research 的参数，如 max_workers、formatting_mode
+        # 多个会话可能在同一秒启动，报告文件名带上运行 ID 避免覆盖
+        self.run_id = options.pop("run_id", None) or Journal.new_run_id()
+        options.setdefault("filename", f"reports/report_{self.run_id}.md")
+        self.state = State()
+        self.events = []                # (时间戳, 进度消息)
+        self.report = ""
+        self.report_path = None
+        self.status = "pending"         # pending / running / done / error / cancelled
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f"research-{topic[:20]}", daemon=True)
+
+    def start(self) -> "ResearchJob":
+        with self._lock:
+            if self.status == "pending":
+                self.status = "running"
+                self.started_at = time.time()
+                self._thread.start()
+        return self
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "error", "cancelled")
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """请求取消：研究在下一次 LLM 调用或进度输出时结束，已在进行的调用不会被中断"""
+        self._cancelled.set()
+        with self._lock:
+            if self.status == "pending":
+                self.status = "cancelled"
+                self.finished_at = time.time()
+
+    def events_since(self, n: int = 0):
+        """返回第 n 条之后的进度事件"""
+        with self._lock:
+            return self.events[n:]
+
+    def _log(self, *args, end="\n", flush=False):
+        # run_research 用 end="" 输出流式报告片段，其余为进度消息
+        if self._cancelled.is_set():
+            raise JobCancelled()
+        text = " ".join(str(arg) for arg in args)
+        with self._lock:
+            if end == "":
+                self.report += text
+            elif text.strip():
+                self.events.append((time.time(), text.strip()))
+
+    def _run(self):
+        try:
+            self.report_path = run_research(self.topic, self.llm_client, state=self.state, run_id=self.run_id,
+                                            log=self._log, **self.options)
+            self.status = "done"
+        except Exception as e:
+            if self._cancelled.is_set():  # JobCancelled，或取消时正在进行的步骤以其他异常结束
+                self.status = "cancelled"
+            else:
+                self.error = f"{type(e).__name__}: {e}"
+                self._log(traceback.format_exc())
+                self.status = "error"
+        finally:
+            self.finished_at = time.time()
+
+
+class JobRegistry:
+    """进程内共享的后台任务表，按 (会话 ID, 主题) 查找任务，页面重新运行时不会重复启动
+
+    每个会话同时只运行一个任务：启动新任务时取消该会话其他仍在运行的任务。
+    已结束的任务保留 retention 秒供页面读取，最多保留 max_finished 个，超出时先淘汰最早结束的"""
+
+    def __init__(self, retention: float = JOB_RETENTION, max_finished: int = JOB_MAX_FINISHED):
+        self.retention = retention
+        self.max_finished = max_finished
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def _evict(self):
+        finished = sorted((job.finished_at or 0, key) for key, job in self._jobs.items() if job.done)
+        expired = [key for finished_at, key in finished if self.retention and time.time() - finished_at > self.retention]
+        overflow = [key for _, key in finished[:max(0, len(finished) - self.max_finished)]]
+        for key in set(expired + overflow):
+            del self._jobs[key]
+
+    def start(self, key, factory, restart: bool = False) -> ResearchJob:
+        """返回 key 对应的任务；不存在（或 restart 且已结束）时用 factory 创建并启动。
+        同一会话中其他仍在运行的任务会被取消并移除"""
+        with self._lock:
+            for other in [k for k, job in self._jobs.items() if k[0] == key[0] and k != key and not job.done]:
+                self._jobs.pop(other).cancel()
+            self._evict()
+            job = self._jobs.get(key)
+            if job is None or (restart and job.done):
+                job = self._jobs[key] = factory()
+        return job.start()
+
+    def cancel(self, key):
+        """取消 key 对应的任务，任务保留在表中，页面可以显示它已取消"""
+        job = self.get(key)
+        if job is not None:
+            job.cancel()
+
+    def discard(self, session_id):
+        """移除某个会话已结束的任务，释放其状态"""
+        with self._lock:
+            for key in [k for k, job in self._jobs.items() if k[0] == session_id and job.done]:
+                del self._jobs[key]
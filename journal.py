@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from state import State, Paragraph, Search
+from config import RUNS_DIR
+
+
+class Journal:
+    """一次研究运行的追加式日志：每行一条 JSON 事件，崩溃或中断后可回放出 State 并从断点继续
+
+    事件类型：
+      run            运行开始，记录研究主题
+      structure      报告结构（段落列表）
+      paragraph      流式生成报告结构时，单个段落一出现就记录，其研究可能早于 structure 事件开始
+      query          段落第 n 次生成的搜索查询（n=0 为初始搜索，n>=1 为第 n 轮反思）
+      search_results 段落第 n 次搜索的结果（链接、标题和正文哈希，正文在 blob 存储中，见 load_results）
+      summary        段落第 n 次总结（n 与反思轮次一致；没有新结果而跳过的轮次记录 skipped 和未改动的总结）
+      stop           段落的反思循环结束，记录原因和最后完成的轮次
+      section        分段格式化模式下段落格式化后的报告章节
+      report         最终报告已保存
+    """
+
+    def __init__(self, run_id: str, root: str = RUNS_DIR):
+        self.run_id = run_id
+        self.path = os.path.join(root, run_id, "journal.jsonl")
+        self.topic = None
+        self.events = {}                  # (op, idx, n) -> 事件，供恢复时查找已完成的步骤
+        self._counts = defaultdict(int)   # (op, idx) -> 已记录次数，即下一条事件的 n
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    @staticmethod
+    def new_run_id() -> str:
+        # 批量模式下同一秒会启动多个运行，加随机后缀避免冲突
+        return f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{uuid.uuid4().hex[:6]}"
+
+    def append(self, op: str, idx: int = None, **data):
+        """追加一条事件并立即落盘"""
+        with self._lock:
+            n = self._counts[(op, idx)]
+            event = {"op": op, "idx": idx, "n": n, **data}
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._remember(event)
+
+    def get(self, op: str, idx: int = None, n: int = 0):
+        """返回已记录的事件，不存在时返回 None"""
+        return self.events.get((op, idx, n))
+
+    def _remember(self, event: dict):
+        self.events[(event["op"], event["idx"], event["n"])] = event
+        self._counts[(event["op"], event["idx"])] = event["n"] + 1
+        if event["op"] == "run":
+            self.topic = event["topic"]
+
+    def replay(self) -> State:
+        """读取日志并重建 State；最后一行若因崩溃写了一半则忽略"""
+        state = State()
+        if not os.path.exists(self.path):
+            return state
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._remember(event)
+                apply_event(state, event)
+        return state
+
+
+def load_results(results: list) -> list:
+    """把 search_results 事件中的结果还原为搜索结果字典（title、url、content），兼容正文内联的旧格式"""
+    return [{"title": r.get("title", ""), "url": r["url"], "content": Search.from_dict(r).content} for r in results]
+
+
+def apply_event(state: State, event: dict):
+    """把一条日志事件应用到 State 上，与各节点 mutate_state 的效果一致"""
+    op = event["op"]
+    if op == "structure":
+        # 流式生成时段落已由 paragraph 事件逐个加入，只补上缺少的部分
+        state.paragraphs.extend(Paragraph(title=p["title"], content=p["content"])
+                                for p in event["paragraphs"][len(state.paragraphs):])
+    elif op == "paragraph":
+        state.paragraphs.append(Paragraph(title=event["title"], content=event["content"]))
+    elif op == "search_results":
+        state.paragraphs[event["idx"]].research.search_history.extend(Search.from_dict(r) for r in event["results"])
+    elif op == "summary":
+        research = state.paragraphs[event["idx"]].research
+        research.latest_summary = event["summary"]
+        research.reflection_iteration = event["n"]
+    elif op == "stop":
+        state.paragraphs[event["idx"]].research.stop_reason = event["reason"]
+    elif op == "section":
+        state.paragraphs[event["idx"]].section = event["section"]
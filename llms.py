@@ -1,30 +1,189 @@
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+import time
+import weakref
 from abc import ABC, abstractmethod
+from typing import AsyncIterator, Iterator
+
+import httpx
 from google import genai
+from google.genai import types
 from zhipuai import ZhipuAI
 
+from cache import create_cache
+from context import estimate_tokens
+from hedging import get_hedger
+from ratelimit import get_rate_limiter
+from tracing import NODE_NAMES, aiterate_in_span, get_tracer, iterate_in_span, record_usage
+from config import (LLM_CACHE_BACKEND, LLM_CACHE_PATH, LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES, LLM_TIMEOUT, LLM_DEADLINE,
+                    LLM_PROMPT_CACHE, LLM_PROMPT_CACHE_TTL, NODE_MODELS)
+
 class BaseLLM(ABC):
     @abstractmethod
     def invoke(self, system_prompt: str, user_prompt: str) -> str:
         pass
 
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        """异步调用；默认放到线程池中执行同步 invoke，子类应提供原生异步实现"""
+        return await asyncio.to_thread(self.invoke, system_prompt, user_prompt)
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        """流式生成，逐段返回文本；默认一次性返回完整结果"""
+        yield self.invoke(system_prompt, user_prompt)
+
+    async def astream(self, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        """异步流式生成；默认一次性返回完整结果"""
+        yield await self.ainvoke(system_prompt, user_prompt)
+
+    def with_models(self, models: dict) -> "BaseLLM":
+        """按 models（服务商 -> 模型名，见 config.NODE_MODELS）返回改用其他模型、共用连接的副本；
+        没有指定本服务商的模型时原样返回。包装类应把调用转给被包装的客户端后重新包装"""
+        model = models.get(getattr(self, "provider", None))
+        if not model or model == self.default_model_type:
+            return self
+        clone = copy.copy(self)
+        clone.default_model_type = model
+        return clone
+
+    def without_cache(self) -> "BaseLLM":
+        """返回去掉所有 CachedLLM 包装的客户端；包装类应对被包装的客户端递归调用后重新包装"""
+        return self
+
 class GeminiLLM(BaseLLM):
-    def __init__(self, api_key: str):
-        self.client = genai.Client(api_key=api_key)
-        self.default_model_type = 'gemini-2.0-flash'
-        
+    provider = "gemini"
+
+    def __init__(self, api_key: str, model: str = None, prompt_cache: bool = LLM_PROMPT_CACHE):
+        self.client = genai.Client(api_key=api_key, http_options={"timeout": int(LLM_TIMEOUT * 1000)})
+        self.default_model_type = model or 'gemini-2.0-flash'
+        # 系统提示词单独作为 system_instruction 发送；prompt_cache 开启时为每个 (模型, 系统提示词)
+        # 创建一个服务端缓存上下文，之后的调用只引用缓存，不再重复发送和计费系统提示词
+        self.prompt_cache = prompt_cache
+        self._cached_contents = {}  # (模型, 系统提示词) -> (缓存名或 None, 过期时间)
+        self._cached_content_locks = {}  # (模型, 系统提示词) -> 创建该缓存时持有的锁
+        self._cached_contents_lock = threading.Lock()
+
+    def _cached_content(self, system_prompt: str):
+        """返回系统提示词对应的缓存上下文名；创建失败（如提示词短于模型的最小缓存长度）时返回 None 且在 TTL 内不再尝试
+
+        创建缓存是一次网络调用，只持有该 (模型, 系统提示词) 的锁，其他节点的调用不会排在它后面。
+        被替换的旧缓存不主动删除：本地提前一分钟换新，它的服务端 TTL 随后即到期，
+        期间刚取到旧缓存名、仍在进行的调用可以继续引用它"""
+        key = (self.default_model_type, system_prompt)
+        with self._cached_contents_lock:
+            name, expires_at = self._cached_contents.get(key, (None, 0.0))
+            if time.monotonic() < expires_at:
+                return name
+            key_lock = self._cached_content_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._cached_contents_lock:
+                name, expires_at = self._cached_contents.get(key, (None, 0.0))
+            if time.monotonic() < expires_at:
+                return name  # 等待期间其他线程已经创建
+            try:
+                cache = self.client.caches.create(model=self.default_model_type, config=types.CreateCachedContentConfig(
+                    system_instruction=system_prompt, ttl=f"{int(LLM_PROMPT_CACHE_TTL)}s",
+                    display_name=NODE_NAMES.get(system_prompt, "llm")))
+                name = cache.name
+            except Exception:
+                name = None
+            with self._cached_contents_lock:
+                # 提前一分钟换新缓存，避免引用刚过期的缓存
+                self._cached_contents[key] = (name, time.monotonic() + max(0.0, LLM_PROMPT_CACHE_TTL - 60))
+            return name
+
+    def _config(self, system_prompt: str, cached_content: str = None) -> types.GenerateContentConfig:
+        if cached_content:
+            return types.GenerateContentConfig(cached_content=cached_content)
+        return types.GenerateContentConfig(system_instruction=system_prompt)
+
+    def _sync_config(self, system_prompt: str) -> types.GenerateContentConfig:
+        return self._config(system_prompt, self._cached_content(system_prompt) if self.prompt_cache else None)
+
+    async def _async_config(self, system_prompt: str) -> types.GenerateContentConfig:
+        cached_content = await asyncio.to_thread(self._cached_content, system_prompt) if self.prompt_cache else None
+        return self._config(system_prompt, cached_content)
+
     def invoke(self, system_prompt: str, user_prompt: str) -> str:
-        combined_prompt = f"{system_prompt}\n{user_prompt}"
-        
         response = self.client.models.generate_content(
             model=self.default_model_type,
-            contents=combined_prompt
+            contents=user_prompt,
+            config=self._sync_config(system_prompt),
+        )
+        self._record_usage(response)
+        return response.text if response.text is not None else ""
+
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        response = await self.client.aio.models.generate_content(
+            model=self.default_model_type,
+            contents=user_prompt,
+            config=await self._async_config(system_prompt),
         )
+        self._record_usage(response)
         return response.text if response.text is not None else ""
 
+    @staticmethod
+    def _record_usage(response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            record_usage(usage.prompt_token_count, usage.candidates_token_count,
+                         cached_input_tokens=usage.cached_content_token_count or 0)
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        usage = None
+        for chunk in self.client.models.generate_content_stream(
+            model=self.default_model_type,
+            contents=user_prompt,
+            config=self._sync_config(system_prompt),
+        ):
+            usage = chunk if getattr(chunk, "usage_metadata", None) else usage
+            if chunk.text:
+                yield chunk.text
+        if usage is not None:
+            self._record_usage(usage)  # 流式响应的用量在最后一个分片中
+
+    async def astream(self, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        usage = None
+        async for chunk in await self.client.aio.models.generate_content_stream(
+            model=self.default_model_type,
+            contents=user_prompt,
+            config=await self._async_config(system_prompt),
+        ):
+            usage = chunk if getattr(chunk, "usage_metadata", None) else usage
+            if chunk.text:
+                yield chunk.text
+        if usage is not None:
+            self._record_usage(usage)
+
 class ZhipuAILLM(BaseLLM):
-    def __init__(self, api_key: str):
-        self.client = ZhipuAI(api_key=api_key) 
-        self.default_model_type = 'charglm-4'
+    provider = "zhipu"
+    base_url = "https://open.bigmodel.cn/api/paas/v4/"
+
+    def __init__(self, api_key: str, model: str = None):
+        self.client = ZhipuAI(api_key=api_key, timeout=LLM_TIMEOUT)
+        self.default_model_type = model or 'charglm-4'
+        # zhipuai SDK 只有同步客户端，异步调用直接请求同一接口；httpx.AsyncClient 绑定事件循环，按循环缓存。
+        # 鉴权用的 JWT 几分钟后过期，每次请求都重新取 auth_headers（SDK 内部会缓存并按时刷新）
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(base_url=self.base_url, timeout=LLM_TIMEOUT)
+            self._async_clients[loop] = client
+        return client
+
+    @staticmethod
+    def _cached_tokens(usage) -> int:
+        """命中服务端前缀缓存的输入 token 数（usage.prompt_tokens_details.cached_tokens，SDK 对象或 JSON 字典）；
+        智谱没有显式的缓存接口，系统提示词作为固定的第一条消息发送，相同前缀由服务端自动缓存"""
+        details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            return details.get("cached_tokens") or 0
+        return getattr(details, "cached_tokens", None) or 0
         
     def invoke(self, system_prompt: str, user_prompt: str) -> str:
         messages = [
@@ -36,9 +195,301 @@ class ZhipuAILLM(BaseLLM):
             model=self.default_model_type,
             messages=messages,
         )
+        if response.usage is not None:
+            record_usage(response.usage.prompt_tokens, response.usage.completion_tokens,
+                         cached_input_tokens=self._cached_tokens(response.usage))
         
         return response.choices[0].message.content if response.choices[0].message.content is not None else ""
 
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        messages = [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_prompt}
+        ]
+
+        response = await self._async_client().post(
+            "chat/completions",
+            json={"model": self.default_model_type, "messages": messages},
+            headers=self.client.auth_headers,
+        )
+        response.raise_for_status()
+        body = response.json()
+        usage = body.get("usage") or {}
+        record_usage(usage.get("prompt_tokens"), usage.get("completion_tokens"),
+                     cached_input_tokens=self._cached_tokens(usage))
+
+        content = body["choices"][0]["message"].get("content")
+        return content if content is not None else ""
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        messages = [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_prompt}
+        ]
+
+        for chunk in self.client.chat.completions.create(
+            model=self.default_model_type,
+            messages=messages,
+            stream=True,
+        ):
+            if getattr(chunk, "usage", None) is not None:
+                record_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens,
+                             cached_input_tokens=self._cached_tokens(chunk.usage))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def astream(self, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        messages = [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_prompt}
+        ]
+
+        # 接口以 SSE 返回，每行 "data: {...}"，以 "data: [DONE]" 结束
+        async with self._async_client().stream(
+            "POST",
+            "chat/completions",
+            json={"model": self.default_model_type, "messages": messages, "stream": True},
+            headers=self.client.auth_headers,
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                data = json.loads(data)
+                if data.get("usage"):
+                    record_usage(data["usage"].get("prompt_tokens"), data["usage"].get("completion_tokens"),
+                                 cached_input_tokens=self._cached_tokens(data["usage"]))
+                choices = data.get("choices") or []
+                content = choices[0].get("delta", {}).get("content") if choices else None
+                if content:
+                    yield content
+
+class CachedLLM(BaseLLM):
+    """为任意 BaseLLM 加上响应缓存，键为提供商、模型、系统提示词和用户提示词的哈希"""
+    def __init__(self, llm: BaseLLM, cache):
+        self.llm = llm
+        self.cache = cache
+        self.default_model_type = getattr(llm, "default_model_type", "")
+        # 键用最内层客户端的类名，限流、对冲等包装不影响缓存命中
+        inner = llm
+        while isinstance(getattr(inner, "llm", None), BaseLLM):
+            inner = inner.llm
+        self.client_name = type(inner).__name__
+
+    def with_models(self, models: dict) -> BaseLLM:
+        return CachedLLM(self.llm.with_models(models), self.cache)
+
+    def without_cache(self) -> BaseLLM:
+        return self.llm.without_cache()
+
+    def cache_key(self, system_prompt: str, user_prompt: str) -> str:
+        key = json.dumps([self.client_name, self.default_model_type, system_prompt, user_prompt], ensure_ascii=False)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def invoke(self, system_prompt: str, user_prompt: str) -> str:
+        key = self.cache_key(system_prompt, user_prompt)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.llm.invoke(system_prompt, user_prompt)
+            if response:  # 空响应多半是出错，不缓存
+                self.cache.set(key, response)
+        return response
+
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        key = self.cache_key(system_prompt, user_prompt)
+        response = self.cache.get(key)
+        if response is None:
+            response = await self.llm.ainvoke(system_prompt, user_prompt)
+            if response:
+                self.cache.set(key, response)
+        return response
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        key = self.cache_key(system_prompt, user_prompt)
+        response = self.cache.get(key)
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        for chunk in self.llm.stream(system_prompt, user_prompt):
+            chunks.append(chunk)
+            yield chunk
+        if chunks:
+            self.cache.set(key, "".join(chunks))
+
+    async def astream(self, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        key = self.cache_key(system_prompt, user_prompt)
+        response = self.cache.get(key)
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        async for chunk in self.llm.astream(system_prompt, user_prompt):
+            chunks.append(chunk)
+            yield chunk
+        if chunks:
+            self.cache.set(key, "".join(chunks))
+
+def for_node(llm_client: BaseLLM, node: str, use_cache: bool = True, models: dict = None) -> BaseLLM:
+    """节点使用的客户端：按 models（默认取 NODE_MODELS 中该节点的配置）换成该节点的模型，use_cache 为 False 时去掉缓存"""
+    models = NODE_MODELS.get(node) if models is None else models
+    if models:
+        llm_client = llm_client.with_models(models)
+    return llm_client if use_cache else uncached(llm_client)
+
+def uncached(llm_client: BaseLLM) -> BaseLLM:
+    """去掉 CachedLLM 包装（无论在追踪、对冲、限流、路由等包装的哪一层），供不希望复用缓存结果的节点使用"""
+    return llm_client.without_cache()
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+def get_llm_cache():
+    """惰性创建全局 LLM 响应缓存；LLM_CACHE_BACKEND 为空时不启用缓存"""
+    global _llm_cache
+    if not LLM_CACHE_BACKEND:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = create_cache(LLM_CACHE_BACKEND, LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES)
+    return _llm_cache
+
+def with_llm_cache(llm_client: BaseLLM) -> BaseLLM:
+    """按配置给客户端加上响应缓存"""
+    cache = get_llm_cache()
+    return CachedLLM(llm_client, cache) if cache is not None else llm_client
+
+class RateLimitedLLM(BaseLLM):
+    """在服务商共享的限流器（见 ratelimit.py）控制下调用 LLM：按请求数、token 数和并发排队，失败时退避重试"""
+    def __init__(self, llm: BaseLLM, limiter):
+        self.llm = llm
+        self.limiter = limiter
+        self.default_model_type = getattr(llm, "default_model_type", "")
+
+    def with_models(self, models: dict) -> BaseLLM:
+        return RateLimitedLLM(self.llm.with_models(models), self.limiter)
+
+    def without_cache(self) -> BaseLLM:
+        return RateLimitedLLM(self.llm.without_cache(), self.limiter)
+
+    def invoke(self, system_prompt: str, user_prompt: str) -> str:
+        return self.limiter.call(lambda: self.llm.invoke(system_prompt, user_prompt),
+                                 tokens=estimate_tokens(system_prompt + user_prompt), output_tokens=estimate_tokens)
+
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        return await self.limiter.acall(lambda: self.llm.ainvoke(system_prompt, user_prompt),
+                                        tokens=estimate_tokens(system_prompt + user_prompt), output_tokens=estimate_tokens)
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        yield from self.limiter.stream(lambda: self.llm.stream(system_prompt, user_prompt),
+                                       tokens=estimate_tokens(system_prompt + user_prompt), output_tokens=estimate_tokens)
+
+    async def astream(self, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        async for chunk in self.limiter.astream(lambda: self.llm.astream(system_prompt, user_prompt),
+                                                tokens=estimate_tokens(system_prompt + user_prompt),
+                                                output_tokens=estimate_tokens):
+            yield chunk
+
+def with_rate_limit(llm_client: BaseLLM) -> BaseLLM:
+    """给客户端加上所属服务商的限流器；应在缓存之内包装，命中缓存的调用不占用限额"""
+    if isinstance(llm_client, RateLimitedLLM):
+        return llm_client
+    provider = getattr(llm_client, "provider", None) or type(llm_client).__name__.lower()
+    return RateLimitedLLM(llm_client, get_rate_limiter(provider))
+
+class HedgedLLM(BaseLLM):
+    """为非流式调用加上截止时间和对冲请求（见 hedging.py），按模型和节点分别统计耗时；
+    流式调用已经开始输出的内容无法对冲，原样透传"""
+    def __init__(self, llm: BaseLLM, hedger, deadline: float = LLM_DEADLINE):
+        self.llm = llm
+        self.hedger = hedger
+        self.deadline = deadline
+        self.default_model_type = getattr(llm, "default_model_type", "")
+
+    def with_models(self, models: dict) -> BaseLLM:
+        return HedgedLLM(self.llm.with_models(models), self.hedger, self.deadline)
+
+    def without_cache(self) -> BaseLLM:
+        return HedgedLLM(self.llm.without_cache(), self.hedger, self.deadline)
+
+    def _key(self, system_prompt: str) -> str:
+        return f"{self.default_model_type}/{NODE_NAMES.get(system_prompt, 'llm')}"
+
+    def invoke(self, system_prompt: str, user_prompt: str) -> str:
+        return self.hedger.call(self._key(system_prompt), lambda: self.llm.invoke(system_prompt, user_prompt),
+                                deadline=self.deadline)
+
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        return await self.hedger.acall(self._key(system_prompt), lambda: self.llm.ainvoke(system_prompt, user_prompt),
+                                       deadline=self.deadline)
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        return self.llm.stream(system_prompt, user_prompt)
+
+    def astream(self, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        return self.llm.astream(system_prompt, user_prompt)
+
+def with_hedging(llm_client: BaseLLM) -> BaseLLM:
+    """给客户端加上截止时间和对冲请求；应包在限流之外，对冲发出的请求同样受限流控制"""
+    if isinstance(llm_client, HedgedLLM):
+        return llm_client
+    return HedgedLLM(llm_client, get_hedger())
+
+class TracedLLM(BaseLLM):
+    """为每次 LLM 调用记录 span：节点名、段落、轮次、提示词和响应大小、token 用量、耗时和错误"""
+    def __init__(self, llm: BaseLLM, tracer):
+        self.llm = llm
+        self.tracer = tracer
+        self.default_model_type = getattr(llm, "default_model_type", "")
+
+    def with_models(self, models: dict) -> BaseLLM:
+        return TracedLLM(self.llm.with_models(models), self.tracer)
+
+    def without_cache(self) -> BaseLLM:
+        return TracedLLM(self.llm.without_cache(), self.tracer)
+
+    def _span(self, system_prompt: str, user_prompt: str, activate: bool = True):
+        return self.tracer.span(NODE_NAMES.get(system_prompt, "llm"), "llm", activate=activate,
+                                model=self.default_model_type, prompt_chars=len(system_prompt) + len(user_prompt))
+
+    def invoke(self, system_prompt: str, user_prompt: str) -> str:
+        with self._span(system_prompt, user_prompt) as span:
+            response = self.llm.invoke(system_prompt, user_prompt)
+            span["response_chars"] = len(response)
+        return response
+
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        with self._span(system_prompt, user_prompt) as span:
+            response = await self.llm.ainvoke(system_prompt, user_prompt)
+            span["response_chars"] = len(response)
+        return response
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        with self._span(system_prompt, user_prompt, activate=False) as span:
+            start, span["response_chars"] = time.perf_counter(), 0
+            for chunk in iterate_in_span(span, iter(self.llm.stream(system_prompt, user_prompt))):
+                span.setdefault("first_chunk_ms", round((time.perf_counter() - start) * 1000, 1))
+                span["response_chars"] += len(chunk)
+                yield chunk
+
+    async def astream(self, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        with self._span(system_prompt, user_prompt, activate=False) as span:
+            start, span["response_chars"] = time.perf_counter(), 0
+            async for chunk in aiterate_in_span(span, self.llm.astream(system_prompt, user_prompt)):
+                span.setdefault("first_chunk_ms", round((time.perf_counter() - start) * 1000, 1))
+                span["response_chars"] += len(chunk)
+                yield chunk
+
+def with_tracing(llm_client: BaseLLM) -> BaseLLM:
+    """开启追踪时给客户端加上 TracedLLM 包装，否则原样返回，不增加任何开销"""
+    tracer = get_tracer()
+    if tracer is None or isinstance(llm_client, TracedLLM):
+        return llm_client
+    return TracedLLM(llm_client, tracer)
+
 # 使用示例
 def main():
     # Gemini示例
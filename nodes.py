@@ -10,16 +10,20 @@ from llms import BaseLLM
 import json
 from json.decoder import JSONDecodeError
 from prompts import (SYSTEM_PROMPT_REPORT_STRUCTURE, SYSTEM_PROMPT_FIRST_SEARCH, 
-                    SYSTEM_PROMPT_FIRST_SUMMARY, SYSTEM_PROMPT_REFLECTION, 
-                    SYSTEM_PROMPT_REFLECTION_SUMMARY, SYSTEM_PROMPT_REPORT_FORMATTING)
+                    SYSTEM_PROMPT_FIRST_SUMMARY, SYSTEM_PROMPT_REFLECTION, SYSTEM_PROMPT_REFLECTION_MULTI,
+                    SYSTEM_PROMPT_REFLECTION_SUMMARY, SYSTEM_PROMPT_REFLECTION_SUMMARY_DELTA, SYSTEM_PROMPT_REPORT_FORMATTING,
+                    SYSTEM_PROMPT_SECTION_FORMATTING, SYSTEM_PROMPT_REPORT_OUTLINE)
 from state import State, Paragraph, Research, Search
-from utils import clean_json_tags, remove_reasoning_from_output, clean_markdown_tags, extract_clean_response
-from llms import BaseLLM
+from utils import (clean_json_tags, remove_reasoning_from_output, clean_markdown_tags, extract_clean_response,
+                   clean_markdown_stream, aclean_markdown_stream, JSONArrayStreamParser, split_summary_blocks,
+                   apply_summary_delta, parse_index)
+from llms import BaseLLM, for_node
+from config import REFLECTION_MAX_QUERIES, REFLECTION_SUMMARY_MODE, DELTA_BLOCK_MAX_CHARS
 
 class ReportStructureNode:
     """生成报告结构的节点"""
-    def __init__(self, llm_client: BaseLLM, query: str):
-        self.llm_client = llm_client
+    def __init__(self, llm_client: BaseLLM, query: str, use_cache: bool = True, models: dict = None):
+        self.llm_client = for_node(llm_client, type(self).__name__, use_cache, models)
         self.query = query
 
     def run(self) -> str:
@@ -27,25 +31,86 @@ class ReportStructureNode:
         response = self.llm_client.invoke(SYSTEM_PROMPT_REPORT_STRUCTURE, self.query)
         return response
 
+    async def arun(self) -> str:
+        """异步调用LLM生成报告结构"""
+        return await self.llm_client.ainvoke(SYSTEM_PROMPT_REPORT_STRUCTURE, self.query)
+
     def mutate_state(self, state: State) -> State:
         """将报告结构写入状态"""
-        report_structure = self.run()
+        return self._update_state(self.run(), state)
+
+    async def amutate_state(self, state: State) -> State:
+        """异步生成报告结构并写入状态"""
+        return self._update_state(await self.arun(), state)
+
+    def stream_mutate_state(self, state: State):
+        """流式生成报告结构：每当一个段落的 JSON 对象闭合，就写入状态并返回它的序号，调用方可以立即开始研究该段落
+
+        state 中已有段落时（恢复中断的流式解析），跳过输出中对应数量的段落"""
+        parser, chunks, parsed = JSONArrayStreamParser(), [], 0
+        for chunk in self.llm_client.stream(SYSTEM_PROMPT_REPORT_STRUCTURE, self.query):
+            chunks.append(chunk)
+            for paragraph in parser.feed(chunk):
+                parsed += 1
+                if parsed > len(state.paragraphs):
+                    yield self._add_paragraph(paragraph, state)
+        if not parsed:
+            # 未能增量解析（如输出不是数组），退回到整体解析
+            start = len(state.paragraphs)
+            self._update_state("".join(chunks), state)
+            yield from range(start, len(state.paragraphs))
+            return
+        state.record("structure", paragraphs=[{"title": p.title, "content": p.content} for p in state.paragraphs])
+
+    async def astream_mutate_state(self, state: State):
+        """stream_mutate_state 的异步版本"""
+        parser, chunks, parsed = JSONArrayStreamParser(), [], 0
+        async for chunk in self.llm_client.astream(SYSTEM_PROMPT_REPORT_STRUCTURE, self.query):
+            chunks.append(chunk)
+            for paragraph in parser.feed(chunk):
+                parsed += 1
+                if parsed > len(state.paragraphs):
+                    yield self._add_paragraph(paragraph, state)
+        if not parsed:
+            start = len(state.paragraphs)
+            self._update_state("".join(chunks), state)
+            for idx in range(start, len(state.paragraphs)):
+                yield idx
+            return
+        state.record("structure", paragraphs=[{"title": p.title, "content": p.content} for p in state.paragraphs])
+
+    def _add_paragraph(self, paragraph: dict, state: State) -> int:
+        state.paragraphs.append(Paragraph(title=paragraph["title"], content=paragraph["content"]))
+        idx = len(state.paragraphs) - 1
+        state.record("paragraph", idx=idx, title=paragraph["title"], content=paragraph["content"])
+        return idx
+
+    def _update_state(self, report_structure: str, state: State) -> State:
         report_structure = remove_reasoning_from_output(report_structure)
         report_structure = clean_json_tags(report_structure)
 
         report_structure = json.loads(report_structure)
-        for paragraph in report_structure:
+        for paragraph in report_structure[len(state.paragraphs):]:
             state.paragraphs.append(Paragraph(title=paragraph["title"], content=paragraph["content"]))
+        state.record("structure", paragraphs=[{"title": p.title, "content": p.content} for p in state.paragraphs])
         return state    
 
 class FirstSearchNode:
     """为段落生成首次搜索查询的节点"""
-    def __init__(self, llm_client: BaseLLM):
-        self.llm_client = llm_client
+    def __init__(self, llm_client: BaseLLM, use_cache: bool = True, models: dict = None):
+        self.llm_client = for_node(llm_client, type(self).__name__, use_cache, models)
 
     def run(self, message: str) -> dict:
         """调用LLM生成搜索查询和理由"""
         response = self.llm_client.invoke(SYSTEM_PROMPT_FIRST_SEARCH, message)
+        return self._parse(response)
+
+    async def arun(self, message: str) -> dict:
+        """异步调用LLM生成搜索查询和理由"""
+        response = await self.llm_client.ainvoke(SYSTEM_PROMPT_FIRST_SEARCH, message)
+        return self._parse(response)
+
+    def _parse(self, response: str) -> dict:
         response = remove_reasoning_from_output(response)
         response = clean_json_tags(response)
         response_dict = extract_clean_response(response)  # 提取干净的JSON字典
@@ -53,17 +118,43 @@ class FirstSearchNode:
 
 class FirstSummaryNode:
     """根据搜索结果生成段落首次总结的节点"""
-    def __init__(self, llm_client: BaseLLM):
-        self.llm_client = llm_client
+    def __init__(self, llm_client: BaseLLM, use_cache: bool = True, models: dict = None):
+        self.llm_client = for_node(llm_client, type(self).__name__, use_cache, models)
 
     def run(self, message: str) -> str:
         """调用LLM生成段落总结"""
         response = self.llm_client.invoke(SYSTEM_PROMPT_FIRST_SUMMARY, message)
         return response
 
+    async def arun(self, message: str) -> str:
+        """异步调用LLM生成段落总结"""
+        return await self.llm_client.ainvoke(SYSTEM_PROMPT_FIRST_SUMMARY, message)
+
     def mutate_state(self, message: str, idx_paragraph: int, state: State) -> State:
         """更新段落的最新总结到状态"""
-        summary = self.run(message)
+        return self._update_state(self.run(message), idx_paragraph, state)
+
+    async def amutate_state(self, message: str, idx_paragraph: int, state: State) -> State:
+        """异步生成段落总结并更新到状态"""
+        return self._update_state(await self.arun(message), idx_paragraph, state)
+
+    def stream_mutate_state(self, message: str, idx_paragraph: int, state: State):
+        """流式生成段落总结，逐段返回原始输出，结束后更新到状态"""
+        chunks = []
+        for chunk in self.llm_client.stream(SYSTEM_PROMPT_FIRST_SUMMARY, message):
+            chunks.append(chunk)
+            yield chunk
+        self._update_state("".join(chunks), idx_paragraph, state)
+
+    async def astream_mutate_state(self, message: str, idx_paragraph: int, state: State):
+        """stream_mutate_state 的异步版本"""
+        chunks = []
+        async for chunk in self.llm_client.astream(SYSTEM_PROMPT_FIRST_SUMMARY, message):
+            chunks.append(chunk)
+            yield chunk
+        self._update_state("".join(chunks), idx_paragraph, state)
+
+    def _update_state(self, summary: str, idx_paragraph: int, state: State) -> State:
         summary = remove_reasoning_from_output(summary)
         summary = clean_json_tags(summary)
         
@@ -73,57 +164,234 @@ class FirstSummaryNode:
             summary = {"paragraph_latest_state": summary}  # 容错处理非JSON输出
 
         state.paragraphs[idx_paragraph].research.latest_summary = summary["paragraph_latest_state"]
+        state.record("summary", idx=idx_paragraph, summary=summary["paragraph_latest_state"])
         return state
 
 class ReflectionNode:
-    """反思段落并生成新搜索查询的节点"""
-    def __init__(self, llm_client: BaseLLM):
-        self.llm_client = llm_client
+    """反思段落并生成新搜索查询的节点
+
+    max_queries（默认取 REFLECTION_MAX_QUERIES）大于 1 时使用多查询提示词，一轮可以针对多个遗漏方面各给出一个查询；
+    返回值中的 search_queries 总是查询列表，search_query 为第一个查询"""
+    def __init__(self, llm_client: BaseLLM, use_cache: bool = True, max_queries: int = None, models: dict = None):
+        self.llm_client = for_node(llm_client, type(self).__name__, use_cache, models)
+        self.max_queries = max(1, max_queries or REFLECTION_MAX_QUERIES)
 
     def run(self, message: str) -> dict:
         """调用LLM反思并生成搜索查询"""
-        response = self.llm_client.invoke(SYSTEM_PROMPT_REFLECTION, message)
+        system_prompt, message = self._prompt(message)
+        response = self.llm_client.invoke(system_prompt, message)
+        return self._parse(response)
+
+    async def arun(self, message: str) -> dict:
+        """异步调用LLM反思并生成搜索查询"""
+        system_prompt, message = self._prompt(message)
+        response = await self.llm_client.ainvoke(system_prompt, message)
+        return self._parse(response)
+
+    def _prompt(self, message: str):
+        if self.max_queries == 1:
+            return SYSTEM_PROMPT_REFLECTION, message
+        data = json.loads(message)
+        data["max_queries"] = self.max_queries
+        return SYSTEM_PROMPT_REFLECTION_MULTI, json.dumps(data, ensure_ascii=False)
+
+    def _parse(self, response: str) -> dict:
         response = remove_reasoning_from_output(response)
         response = clean_json_tags(response)
         response_dict = extract_clean_response(response)
+        queries = response_dict.get("search_queries")
+        if isinstance(queries, str):
+            queries = [queries]
+        if not isinstance(queries, list) or not queries:
+            queries = [response_dict.get("search_query")]
+        # 去掉空查询和重复查询，并限制数量
+        unique = []
+        for query in queries:
+            query = query.strip() if isinstance(query, str) else ""
+            if query and query not in unique:
+                unique.append(query)
+        response_dict["search_queries"] = unique[:self.max_queries] or [""]
+        response_dict["search_query"] = response_dict["search_queries"][0]
         return response_dict
 
 class ReflectionSummaryNode:
-    """根据反思搜索结果更新段落总结的节点"""
-    def __init__(self, llm_client: BaseLLM):
-        self.llm_client = llm_client
+    """根据反思搜索结果更新段落总结的节点
+
+    mode（默认取 REFLECTION_SUMMARY_MODE）为 delta 时，段落最新状态切分为编号文本块发送，
+    模型只返回对文本块的修改和新增内容，由 _update_state 合并到当前总结，输出长度不随段落变长而增长"""
+    def __init__(self, llm_client: BaseLLM, use_cache: bool = True, models: dict = None, mode: str = None):
+        self.llm_client = for_node(llm_client, type(self).__name__, use_cache, models)
+        self.mode = mode or REFLECTION_SUMMARY_MODE
+
+    def _prompt(self, message: str):
+        """返回本次调用使用的系统提示词和消息；delta 模式下把 paragraph_latest_state 换成编号文本块"""
+        if self.mode != "delta":
+            return SYSTEM_PROMPT_REFLECTION_SUMMARY, message
+        data = json.loads(message)
+        blocks = split_summary_blocks(data.pop("paragraph_latest_state", ""), DELTA_BLOCK_MAX_CHARS)
+        data["paragraph_blocks"] = [{"id": i, "text": text} for i, (_, text) in enumerate(blocks)]
+        return SYSTEM_PROMPT_REFLECTION_SUMMARY_DELTA, json.dumps(data, ensure_ascii=False)
 
     def run(self, message: str) -> str:
         """调用LLM更新段落内容"""
-        response = self.llm_client.invoke(SYSTEM_PROMPT_REFLECTION_SUMMARY, message)
+        response = self.llm_client.invoke(*self._prompt(message))
         return response
 
+    async def arun(self, message: str) -> str:
+        """异步调用LLM更新段落内容"""
+        return await self.llm_client.ainvoke(*self._prompt(message))
+
     def mutate_state(self, message: str, idx_paragraph: int, state: State) -> State:
         """将更新后的总结写入状态"""
-        summary = self.run(message)
+        return self._update_state(self.run(message), idx_paragraph, state)
+
+    async def amutate_state(self, message: str, idx_paragraph: int, state: State) -> State:
+        """异步更新总结并写入状态"""
+        return self._update_state(await self.arun(message), idx_paragraph, state)
+
+    def stream_mutate_state(self, message: str, idx_paragraph: int, state: State):
+        """流式更新段落总结，逐段返回原始输出，结束后写入状态"""
+        chunks = []
+        for chunk in self.llm_client.stream(*self._prompt(message)):
+            chunks.append(chunk)
+            yield chunk
+        self._update_state("".join(chunks), idx_paragraph, state)
+
+    async def astream_mutate_state(self, message: str, idx_paragraph: int, state: State):
+        """stream_mutate_state 的异步版本"""
+        chunks = []
+        async for chunk in self.llm_client.astream(*self._prompt(message)):
+            chunks.append(chunk)
+            yield chunk
+        self._update_state("".join(chunks), idx_paragraph, state)
+
+    def _update_state(self, summary: str, idx_paragraph: int, state: State) -> State:
         summary = remove_reasoning_from_output(summary)
         summary = clean_json_tags(summary)
+        research = state.paragraphs[idx_paragraph].research
 
         try:
-            summary = json.loads(summary)
+            parsed = json.loads(summary)
         except JSONDecodeError:
-            summary = {"updated_paragraph_latest_state": summary}  # 容错处理
+            parsed = None
 
-        state.paragraphs[idx_paragraph].research.latest_summary = summary["updated_paragraph_latest_state"]
+        if isinstance(parsed, dict) and "updated_paragraph_latest_state" in parsed:
+            research.latest_summary = parsed["updated_paragraph_latest_state"]
+        elif self.mode != "delta":
+            research.latest_summary = summary  # 容错处理：不是预期的 JSON 时使用原始输出
+        elif isinstance(parsed, dict):
+            research.latest_summary = apply_summary_delta(research.latest_summary, parsed, DELTA_BLOCK_MAX_CHARS)
+        elif not summary.strip().startswith(("{", "[")):
+            # 无法解析的增量输出：纯文本作为新增内容追加，残缺的 JSON 丢弃，已有总结保持不变
+            research.latest_summary = apply_summary_delta(research.latest_summary, {"additions": [{"text": summary}]},
+                                                          DELTA_BLOCK_MAX_CHARS)
+        research.reflection_iteration += 1
+        state.record("summary", idx=idx_paragraph, summary=research.latest_summary)
         return state
 
 class ReportFormattingNode:
     """格式化最终报告的节点"""
-    def __init__(self, llm_client: BaseLLM):
-        self.llm_client = llm_client
+    def __init__(self, llm_client: BaseLLM, use_cache: bool = True, models: dict = None):
+        self.llm_client = for_node(llm_client, type(self).__name__, use_cache, models)
 
     def run(self, message: str) -> str:
         """调用LLM生成Markdown格式报告"""
         response = self.llm_client.invoke(SYSTEM_PROMPT_REPORT_FORMATTING, message)
+        return self._parse(response)
+
+    async def arun(self, message: str) -> str:
+        """异步调用LLM生成Markdown格式报告"""
+        response = await self.llm_client.ainvoke(SYSTEM_PROMPT_REPORT_FORMATTING, message)
+        return self._parse(response)
+
+    def stream(self, message: str):
+        """流式生成Markdown格式报告，逐段返回清理后的文本"""
+        yield from clean_markdown_stream(self.llm_client.stream(SYSTEM_PROMPT_REPORT_FORMATTING, message))
+
+    async def astream(self, message: str):
+        """异步流式生成Markdown格式报告"""
+        async for chunk in aclean_markdown_stream(self.llm_client.astream(SYSTEM_PROMPT_REPORT_FORMATTING, message)):
+            yield chunk
+
+    def _parse(self, response: str) -> str:
         response = remove_reasoning_from_output(response)
         response = clean_markdown_tags(response)
         return response
 
+class SectionFormattingNode:
+    """把单个段落格式化为报告章节的节点（分段格式化模式的 map 步骤）"""
+    def __init__(self, llm_client: BaseLLM, use_cache: bool = True, models: dict = None):
+        self.llm_client = for_node(llm_client, type(self).__name__, use_cache, models)
+
+    def run(self, message: str) -> str:
+        """调用LLM生成Markdown格式的章节"""
+        response = self.llm_client.invoke(SYSTEM_PROMPT_SECTION_FORMATTING, message)
+        return self._parse(response)
+
+    async def arun(self, message: str) -> str:
+        """异步调用LLM生成Markdown格式的章节"""
+        response = await self.llm_client.ainvoke(SYSTEM_PROMPT_SECTION_FORMATTING, message)
+        return self._parse(response)
+
+    def mutate_state(self, message: str, idx_paragraph: int, state: State) -> State:
+        """将格式化后的章节写入状态"""
+        return self._update_state(self.run(message), idx_paragraph, state)
+
+    async def amutate_state(self, message: str, idx_paragraph: int, state: State) -> State:
+        """异步格式化章节并写入状态"""
+        return self._update_state(await self.arun(message), idx_paragraph, state)
+
+    def _parse(self, response: str) -> str:
+        response = remove_reasoning_from_output(response)
+        response = clean_markdown_tags(response)
+        return response.strip()
+
+    def _update_state(self, section: str, idx_paragraph: int, state: State) -> State:
+        state.paragraphs[idx_paragraph].section = section
+        state.record("section", idx=idx_paragraph, section=section)
+        return state
+
+class ReportOutlineNode:
+    """撰写报告标题、引言和结论并确定章节顺序的节点（分段格式化模式的 reduce 步骤）"""
+    def __init__(self, llm_client: BaseLLM, use_cache: bool = True, models: dict = None):
+        self.llm_client = for_node(llm_client, type(self).__name__, use_cache, models)
+
+    def run(self, message: str) -> dict:
+        """调用LLM生成报告框架"""
+        response = self.llm_client.invoke(SYSTEM_PROMPT_REPORT_OUTLINE, message)
+        return self._parse(response)
+
+    async def arun(self, message: str) -> dict:
+        """异步调用LLM生成报告框架"""
+        response = await self.llm_client.ainvoke(SYSTEM_PROMPT_REPORT_OUTLINE, message)
+        return self._parse(response)
+
+    def _parse(self, response: str) -> dict:
+        response = remove_reasoning_from_output(response)
+        response = clean_json_tags(response)
+        try:
+            outline = json.loads(response)
+        except JSONDecodeError:
+            outline = {"introduction": response}  # 容错处理非JSON输出
+        return outline if isinstance(outline, dict) else {}
+
+    @staticmethod
+    def render(outline: dict, sections: list):
+        """按框架拼接报告，逐段返回 Markdown；章节顺序不合法（编号缺失、重复或不是整数）时保持原顺序，
+        标题、引言和结论不是字符串时按字符串处理"""
+        order = outline.get("section_order")
+        order = [parse_index(i) for i in order] if isinstance(order, list) else None
+        if order is None or None in order or sorted(order) != list(range(len(sections))):
+            order = range(len(sections))
+        if outline.get("report_title"):
+            yield f"# {str(outline['report_title']).strip()}\n\n"
+        if outline.get("introduction"):
+            yield f"{str(outline['introduction']).strip()}\n\n"
+        for i in order:
+            yield f"{sections[i].strip()}\n\n"
+        if outline.get("conclusion"):
+            yield f"## 结论\n\n{str(outline['conclusion']).strip()}\n"
+
 
 def main():
     from llms import GeminiLLM
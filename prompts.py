@@ -143,6 +143,47 @@ SYSTEM_PROMPT_REFLECTION = f"""
 只返回JSON对象，不要有解释或额外文本。
 """
 
+## 多查询反思的 SYSTEM PROMPT：一轮反思针对多个遗漏方面分别给出查询，并发搜索后合并总结
+
+input_schema_reflection_multi = {
+            "type": "object",
+            "properties": {
+                **input_schema_reflection["properties"],
+                "max_queries": {"type": "integer"}
+            }
+        }
+
+output_schema_reflection_multi = {
+            "type": "object",
+            "properties": {
+                "search_queries": {
+                    "type": "array",
+                    "items": {"type": "string"}
+                },
+                "reasoning": {"type": "string"}
+            }
+        }
+
+SYSTEM_PROMPT_REFLECTION_MULTI = f"""
+你是一位深度研究助手。你负责为研究报告构建全面的段落。你将获得段落标题、计划内容摘要、你已经创建的段落最新状态，以及本轮最多可以提出的查询数，所有这些都将按照以下JSON模式定义提供：
+
+<INPUT JSON SCHEMA>
+{json.dumps(input_schema_reflection_multi, indent=2)}
+</INPUT JSON SCHEMA>
+
+你可以使用一个网络搜索工具，该工具接受'search_query'作为参数，多个查询会同时执行。
+你的任务是反思段落文本的当前状态，找出遗漏的主题关键方面，并为每个方面分别提供最佳的网络搜索查询来丰富最新状态。
+查询之间不要重复，数量不超过'max_queries'；如果只遗漏了一个方面，只返回一个查询即可。
+请按照以下JSON模式定义格式化输出：
+
+<OUTPUT JSON SCHEMA>
+{json.dumps(output_schema_reflection_multi, indent=2)}
+</OUTPUT JSON SCHEMA>
+
+确保输出是一个符合上述输出JSON模式定义的JSON对象。
+只返回JSON对象，不要有解释或额外文本。
+"""
+
 
 ## 总结反思的 SYSTEM PROMPT 
 
@@ -190,6 +231,81 @@ SYSTEM_PROMPT_REFLECTION_SUMMARY = f"""
 只返回JSON对象，不要有解释或额外文本。
 """
 
+## 增量总结反思的 SYSTEM PROMPT：只输出对当前段落的新增和修改，由程序在本地合并
+
+input_schema_reflection_summary_delta = {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string"},
+                "content": {"type": "string"},
+                "search_query": {"type": "string"},
+                "search_results": {
+                    "type": "array",
+                    "items": {"type": "string"}
+                },
+                "paragraph_blocks": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "text": {"type": "string"}
+                        }
+                    }
+                }
+            }
+        }
+
+output_schema_reflection_summary_delta = {
+            "type": "object",
+            "properties": {
+                "edits": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "text": {"type": "string"}
+                        }
+                    }
+                },
+                "additions": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "after": {"type": "integer"},
+                            "text": {"type": "string"}
+                        }
+                    }
+                }
+            }
+        }
+
+SYSTEM_PROMPT_REFLECTION_SUMMARY_DELTA = f"""
+你是一位深度研究助手。
+你将获得搜索查询、搜索结果、段落标题以及你正在研究的报告段落的预期内容。
+你正在迭代完善这个段落，段落的最新状态已切分为带编号的文本块（paragraph_blocks）提供给你。
+数据将按照以下JSON模式定义提供：
+
+<INPUT JSON SCHEMA>
+{json.dumps(input_schema_reflection_summary_delta, indent=2)}
+</INPUT JSON SCHEMA>
+
+你的任务是根据搜索结果和预期内容丰富段落，但不要重写整个段落，只输出改动：
+- edits：需要修正或补充的已有文本块，id 为块编号，text 为该块修改后的完整文本；
+- additions：新增的内容，after 为插入位置之前的块编号（省略时追加到段落末尾），text 为新增的文本。
+没有改动的块不要输出；不要删除已有的关键信息；没有需要补充的信息时输出空的 edits 和 additions。
+请按照以下JSON模式定义格式化输出：
+
+<OUTPUT JSON SCHEMA>
+{json.dumps(output_schema_reflection_summary_delta, indent=2)}
+</OUTPUT JSON SCHEMA>
+
+确保输出是一个符合上述输出JSON模式定义的JSON对象。
+只返回JSON对象，不要有解释或额外文本。
+"""
+
 ## 最终研究报告格式化的 SYSTEM PROMPT 
 
 input_schema_report_formatting = {
@@ -214,4 +330,74 @@ SYSTEM_PROMPT_REPORT_FORMATTING = f"""
 你的任务是将报告格式化为美观的形式，并以Markdown格式返回。
 如果没有结论段落，请根据其他段落的最新状态在报告末尾添加一个结论。
 使用段落标题来创建报告的标题。
-"""
\ No newline at end of file
+"""
+
+## 分段格式化（map）的 SYSTEM PROMPT：段落研究完成后立即把它格式化成报告中的一节
+
+input_schema_section_formatting = {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string"},
+                "content": {"type": "string"},
+                "paragraph_latest_state": {"type": "string"}
+            }
+        }
+
+SYSTEM_PROMPT_SECTION_FORMATTING = f"""
+你是一位深度研究助手。你已经完成了研究报告中一个段落的研究，需要把它整理为报告中的一节。
+你将获得以下JSON格式的数据：
+
+<INPUT JSON SCHEMA>
+{json.dumps(input_schema_section_formatting, indent=2)}
+</INPUT JSON SCHEMA>
+
+你的任务是将段落的最新状态格式化为美观的报告章节，并以Markdown格式返回。
+以二级标题（## 段落标题）开头，可以使用三级及以下标题、列表和表格组织内容。
+不要添加报告标题、引言或全文结论，这些会在之后统一撰写。
+"""
+
+## 报告整合（reduce）的 SYSTEM PROMPT：只撰写报告标题、引言、结论并确定章节顺序
+
+input_schema_report_outline = {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "index": {"type": "integer"},
+                    "title": {"type": "string"},
+                    "digest": {"type": "string"}
+            }
+        }
+    }
+
+output_schema_report_outline = {
+            "type": "object",
+            "properties": {
+                "report_title": {"type": "string"},
+                "introduction": {"type": "string"},
+                "conclusion": {"type": "string"},
+                "section_order": {
+                    "type": "array",
+                    "items": {"type": "integer"}
+                }
+            }
+        }
+
+SYSTEM_PROMPT_REPORT_OUTLINE = f"""
+你是一位深度研究助手。研究报告的各个章节已经分别写好，你将获得每一节的序号、标题和开头摘录，格式如下：
+
+<INPUT JSON SCHEMA>
+{json.dumps(input_schema_report_outline, indent=2)}
+</INPUT JSON SCHEMA>
+
+你的任务是为整篇报告撰写标题、引言和结论，并给出各章节在报告中的顺序（使用输入中的序号，每个序号恰好出现一次）。
+引言和结论使用Markdown格式，不要包含标题行，也不要重复各章节的内容。
+请按照以下JSON模式定义格式化输出：
+
+<OUTPUT JSON SCHEMA>
+{json.dumps(output_schema_report_outline, indent=2)}
+</OUTPUT JSON SCHEMA>
+
+确保输出是一个符合上述输出JSON模式定义的JSON对象。
+只返回JSON对象，不要有解释或额外文本。
+"""
@@ -0,0 +1,424 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from tracing import record_usage
+from config import (RATE_LIMITS, RATE_LIMIT_MAX_RETRIES, RATE_LIMIT_BASE_DELAY, RATE_LIMIT_MAX_DELAY,
+                    RATE_LIMIT_LATENCY_TOLERANCE)
+
+# 可重试的 HTTP 状态码：限流、超时和服务端错误
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class TokenBucket:
+    """令牌桶：每分钟补充 per_minute 个令牌，最多积攒一分钟的量；per_minute 为 0 时不限制"""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def acquire(self, amount: float = 1) -> float:
+        """取出 amount 个令牌，不足时阻塞等待；返回等待的秒数"""
+        if not self.per_minute:
+            return 0.0
+        amount = min(amount, self.capacity)  # 单次请求超过桶容量时按满桶处理，避免永远等不到
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) * 60 / self.per_minute
+            time.sleep(delay)
+            waited += delay
+
+    async def aacquire(self, amount: float = 1) -> float:
+        """acquire 的异步版本：令牌不足时在事件循环中等待补充，不占用线程"""
+        if not self.per_minute:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) * 60 / self.per_minute
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def debit(self, amount: float):
+        """事后扣除令牌（如响应的输出 token 数），允许暂时为负，之后的请求会相应等待更久"""
+        if self.per_minute:
+            with self._lock:
+                self._refill(time.monotonic())
+                self.tokens -= amount
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+
+class AIMDLimiter:
+    """AIMD 并发控制：每次成功把并发上限加 1/上限（约每轮加 1），
+    遇到限流或延迟明显升高时减半（每个冷却期最多一次）"""
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1, latency_tolerance: float = 0.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance  # 短期延迟超过长期基线的倍数时视为拥塞，0 为不按延迟调整
+        self.in_flight = 0
+        self.waiting = 0
+        self.fast_latency = None   # 短期延迟 EWMA
+        self.slow_latency = None   # 长期延迟 EWMA，作为基线
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = []   # (事件循环, future)：等待名额的异步调用，release 时唤醒
+
+    def acquire(self) -> float:
+        """等待一个并发名额；返回等待的秒数"""
+        start = time.monotonic()
+        with self._cond:
+            self.waiting += 1
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+        return time.monotonic() - start
+
+    async def aacquire(self) -> float:
+        """acquire 的异步版本：在事件循环中等待 release 唤醒，不占用线程；被取消时不会占用名额"""
+        start, loop, waiter = time.monotonic(), asyncio.get_running_loop(), None
+        with self._cond:
+            self.waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    if self.in_flight < int(self.limit):
+                        self.in_flight += 1
+                        return time.monotonic() - start
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                await waiter
+        finally:
+            with self._cond:
+                self.waiting -= 1
+                if waiter is not None and not waiter.done():
+                    self._async_waiters.remove((loop, waiter))
+
+    def release(self, latency: float = None, congested: bool = False):
+        with self._cond:
+            self.in_flight -= 1
+            if latency is not None:
+                self.fast_latency = latency if self.fast_latency is None else 0.7 * self.fast_latency + 0.3 * latency
+                self.slow_latency = latency if self.slow_latency is None else 0.98 * self.slow_latency + 0.02 * latency
+                if self.latency_tolerance and self.fast_latency > self.latency_tolerance * self.slow_latency:
+                    congested = True
+            if congested:
+                self._decrease()
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _decrease(self):
+        now = time.monotonic()
+        cooldown = max(1.0, self.fast_latency or 0.0)  # 同一批并发请求的多次失败只减一次
+        if now - self._last_decrease >= cooldown:
+            self.limit = max(self.minimum, self.limit / 2)
+            self._last_decrease = now
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def status_code(error):
+    """从各 SDK 的异常中取出 HTTP 状态码（requests / httpx / zhipuai / google-genai）"""
+    for value in (getattr(error, "status_code", None), getattr(error, "code", None),
+                  getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(value, int):
+            return value
+    return None
+
+def retry_after(error):
+    """解析响应头中的 Retry-After（秒数或 HTTP 日期），没有时返回 None"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def is_retryable(error):
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    # 各 SDK 的超时和连接错误类名都包含 Timeout / Connection
+    name = type(error).__name__
+    return isinstance(error, (TimeoutError, ConnectionError)) or "Timeout" in name or "Connection" in name
+
+
+class ProviderLimiter:
+    """一个服务商（zhipu / gemini / tavily 等）共享的限流器：
+    每分钟请求数和 token 数的令牌桶、AIMD 并发上限，以及带抖动、遵守 Retry-After 的指数退避重试"""
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0, max_concurrency: int = 16,
+                 max_retries: int = RATE_LIMIT_MAX_RETRIES, base_delay: float = RATE_LIMIT_BASE_DELAY,
+                 max_delay: float = RATE_LIMIT_MAX_DELAY, latency_tolerance: float = RATE_LIMIT_LATENCY_TOLERANCE):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AIMDLimiter(initial=max(1, max_concurrency // 2), maximum=max_concurrency,
+                                       latency_tolerance=latency_tolerance)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = random.Random()
+        self.counts = {"calls": 0, "retries": 0, "throttled": 0, "failures": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def acquire(self, tokens: float = 0) -> float:
+        """等待并发名额和令牌；返回排队的秒数"""
+        waited = self.concurrency.acquire()
+        waited += self.requests.acquire(1)
+        if tokens:
+            waited += self.tokens.acquire(tokens)
+        return waited
+
+    def release(self, latency: float = None, error=None, output_tokens: float = 0):
+        if output_tokens:
+            self.tokens.debit(output_tokens)
+        throttled = error is not None and status_code(error) == 429
+        if throttled:
+            self._count("throttled")
+        # 失败的请求不计入延迟统计；限流和超时都视为拥塞
+        self.concurrency.release(latency=None if error is not None else latency,
+                                 congested=error is not None and is_retryable(error))
+
+    def backoff(self, attempt: int, error):
+        """返回第 attempt 次失败后重试前应等待的秒数；不可重试或已达重试上限时返回 None"""
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        delay = retry_after(error)
+        if delay is None:
+            delay = self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))  # full jitter
+        return min(delay, self.max_delay)
+
+    def _failed(self, attempt: int, error, queued: float, retryable: bool = True):
+        """记录一次失败并返回重试前的等待秒数；不再重试时返回 None"""
+        self.release(error=error)
+        delay = self.backoff(attempt, error) if retryable else None
+        self._count("failures" if delay is None else "retries")
+        record_usage(queue_ms=round(queued * 1000), retries=0 if delay is None else 1)
+        return delay
+
+    def _succeeded(self, start: float, queued: float, output_tokens: float = 0):
+        self.release(latency=time.monotonic() - start, output_tokens=output_tokens)
+        record_usage(queue_ms=round(queued * 1000))
+
+    def call(self, fn, tokens: float = 0, output_tokens=None):
+        """在限流器控制下调用 fn()，失败时按退避策略重试；output_tokens(result) 用于事后扣除输出 token"""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            queued = self.acquire(tokens)
+            start = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._failed(attempt, e, queued)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.release()  # KeyboardInterrupt 等：不计入统计，但必须归还并发名额
+                raise
+            self._succeeded(start, queued, output_tokens(result) if output_tokens else 0)
+            return result
+
+    async def aacquire(self, tokens: float = 0) -> float:
+        """acquire 的异步版本，在事件循环中等待，不占用线程；拿到并发名额后等待令牌时被取消会归还名额"""
+        waited = await self.concurrency.aacquire()
+        try:
+            waited += await self.requests.aacquire(1)
+            if tokens:
+                waited += await self.tokens.aacquire(tokens)
+        except BaseException:
+            self.release()
+            raise
+        return waited
+
+    async def acall(self, fn, tokens: float = 0, output_tokens=None):
+        """call 的异步版本，fn() 返回协程；排队等待在事件循环中进行，不占用线程"""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            queued = await self.aacquire(tokens)
+            start = time.monotonic()
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._failed(attempt, e, queued)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.release()  # 被取消（对冲落败、超过截止时间）：归还并发名额后继续抛出
+                raise
+            self._succeeded(start, queued, output_tokens(result) if output_tokens else 0)
+            return result
+
+    def stream(self, fn, tokens: float = 0, output_tokens=None):
+        """在限流器控制下迭代 fn() 返回的流；只有在收到第一个片段之前失败才会重试"""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            queued = self.acquire(tokens)
+            start, chunks = time.monotonic(), []
+            try:
+                for chunk in fn():
+                    chunks.append(chunk)
+                    yield chunk
+            except GeneratorExit:
+                self._succeeded(start, queued)  # 调用方提前停止读取
+                raise
+            except Exception as e:
+                delay = self._failed(attempt, e, queued, retryable=not chunks)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self._succeeded(start, queued, output_tokens("".join(chunks)) if output_tokens else 0)
+            return
+
+    async def astream(self, fn, tokens: float = 0, output_tokens=None):
+        """stream 的异步版本，fn() 返回异步迭代器"""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            queued = await self.aacquire(tokens)
+            start, chunks = time.monotonic(), []
+            try:
+                async for chunk in fn():
+                    chunks.append(chunk)
+                    yield chunk
+            except GeneratorExit:
+                self._succeeded(start, queued)
+                raise
+            except Exception as e:
+                delay = self._failed(attempt, e, queued, retryable=not chunks)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self._succeeded(start, queued, output_tokens("".join(chunks)) if output_tokens else 0)
+            return
+
+    def stats(self) -> dict:
+        """当前的限额、并发上限和排队情况"""
+        c = self.concurrency
+        return {
+            "rpm": self.requests.per_minute or None,
+            "tpm": self.tokens.per_minute or None,
+            "requests_available": round(self.requests.available(), 1) if self.requests.per_minute else None,
+            "tokens_available": round(self.tokens.available()) if self.tokens.per_minute else None,
+            "concurrency_limit": round(c.limit, 2),
+            "in_flight": c.in_flight,
+            "queued": c.waiting,
+            **self.counts,
+        }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider: str) -> ProviderLimiter:
+    """返回服务商共享的限流器，限额取自 RATE_LIMITS 配置"""
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = ProviderLimiter(provider, **RATE_LIMITS.get(provider, {}))
+        return _limiters[provider]
+
+def rate_limit_stats() -> dict:
+    """所有已使用的服务商限流器的当前状态"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
+
+
+def _check_cancellation():
+    """回归检查：被取消的异步调用（对冲落败、超过截止时间）必须归还并发名额，否则之后的调用会永远排队"""
+    from hedging import Hedger, DeadlineExceeded
+
+    limiter = ProviderLimiter("check", max_concurrency=2, max_retries=0)
+    hedger = Hedger(enabled=False)
+
+    async def hang():
+        await asyncio.sleep(3600)
+
+    async def main():
+        for _ in range(3):
+            try:
+                await hedger.acall("check", lambda: limiter.acall(hang), deadline=0.05)
+            except DeadlineExceeded:
+                pass
+        await asyncio.sleep(0)  # 对冲器只取消、不等待落后的调用，让它们处理取消并归还名额
+        assert limiter.concurrency.in_flight == 0, limiter.stats()
+        return await asyncio.wait_for(limiter.acall(lambda: asyncio.sleep(0, "ok")), timeout=1)
+
+    assert asyncio.run(main()) == "ok"
+    print("ok:", limiter.stats())
+
+def _check_async_queue():
+    """回归检查：排队的异步调用不能占用线程，否则正在执行的调用需要 asyncio.to_thread 时会因线程池耗尽而死锁"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    limiter = ProviderLimiter("check", max_concurrency=2, max_retries=0)
+
+    async def work():
+        return await asyncio.to_thread(time.sleep, 0.01)
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=2))
+        await asyncio.wait_for(asyncio.gather(*(limiter.acall(work) for _ in range(15))), timeout=5)
+        assert limiter.concurrency.in_flight == 0 and limiter.concurrency.waiting == 0, limiter.stats()
+
+    asyncio.run(main())
+    print("ok:", limiter.stats())
+
+if __name__ == "__main__":
+    _check_cancellation()
+    _check_async_queue()
@@ -0,0 +1,205 @@
+import random
+import threading
+import time
+from typing import AsyncIterator, Iterator
+
+from llms import BaseLLM, GeminiLLM, ZhipuAILLM, with_hedging, with_rate_limit
+from tracing import NODE_NAMES, record_usage
+from config import (GEMINI_API_KEY, ZHIPUAI_API_KEY, LLM_PROVIDERS, ROUTER_LATENCY_ALPHA, ROUTER_MAX_ERROR_RATE,
+                    ROUTER_COOLDOWN, ROUTER_EXPLORE_RATE)
+
+PROVIDERS = {"zhipu": ZhipuAILLM, "gemini": GeminiLLM}
+
+
+class ProviderHealth:
+    """按 (服务商, 节点) 统计的调用质量：延迟和错误率的 EWMA，以及最近一次失败的时间
+
+    错误率超过 max_error_rate 的服务商视为不健康，在 cooldown 秒内不再优先使用；
+    冷却期过后重新参与路由（半开），成功一次即逐步恢复。"""
+
+    def __init__(self, alpha: float = ROUTER_LATENCY_ALPHA, max_error_rate: float = ROUTER_MAX_ERROR_RATE,
+                 cooldown: float = ROUTER_COOLDOWN):
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, provider, node):
+        key = (provider, node)
+        if key not in self.entries:
+            self.entries[key] = {"latency": None, "error_rate": 0.0, "calls": 0, "errors": 0, "last_error_at": 0.0}
+        return self.entries[key]
+
+    def record(self, provider: str, node: str, latency: float = None, error: bool = False):
+        with self._lock:
+            entry = self._entry(provider, node)
+            entry["calls"] += 1
+            entry["error_rate"] = (1 - self.alpha) * entry["error_rate"] + self.alpha * error
+            if error:
+                entry["errors"] += 1
+                entry["last_error_at"] = time.monotonic()
+            elif latency is not None:
+                entry["latency"] = latency if entry["latency"] is None else \
+                    (1 - self.alpha) * entry["latency"] + self.alpha * latency
+
+    def healthy(self, provider: str, node: str) -> bool:
+        with self._lock:
+            entry = self._entry(provider, node)
+            return entry["error_rate"] <= self.max_error_rate or \
+                time.monotonic() - entry["last_error_at"] >= self.cooldown
+
+    def latency(self, provider: str, node: str):
+        with self._lock:
+            return self._entry(provider, node)["latency"]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = {key: dict(entry) for key, entry in self.entries.items()}
+        return {f"{provider}/{node}": {
+            "latency": round(entry["latency"], 3) if entry["latency"] is not None else None,
+            "error_rate": round(entry["error_rate"], 3),
+            "calls": entry["calls"],
+            "errors": entry["errors"],
+            "healthy": self.healthy(provider, node),
+        } for (provider, node), entry in entries.items()}
+
+
+class RouterLLM(BaseLLM):
+    """在多个服务商之上实现 BaseLLM：每次调用按节点选择当前延迟 EWMA 最低的健康服务商，失败时依次切换到其他服务商
+
+    还没有延迟样本的服务商优先尝试一次，以 explore_rate 的概率随机选择健康服务商以更新统计；
+    所有服务商都不健康时仍按延迟顺序尝试。流式调用只在收到第一个片段之前切换。"""
+
+    def __init__(self, llms: dict, health: ProviderHealth, explore_rate: float = ROUTER_EXPLORE_RATE):
+        self.llms = llms  # 服务商名 -> 客户端，顺序即延迟相同时的优先顺序
+        self.health = health
+        self.explore_rate = explore_rate
+        self.rng = random.Random()
+        self.default_model_type = "+".join(getattr(llm, "default_model_type", name) for name, llm in llms.items())
+
+    def with_models(self, models: dict) -> BaseLLM:
+        """只在 models 指定了模型的服务商之间路由，各自换成指定的模型；都没有指定时保留所有服务商"""
+        llms = {name: llm.with_models(models) for name, llm in self.llms.items() if name in models}
+        if not llms:
+            return self
+        if len(llms) == 1:
+            return next(iter(llms.values()))
+        return RouterLLM(llms, self.health, self.explore_rate)
+
+    def without_cache(self) -> BaseLLM:
+        return RouterLLM({name: llm.without_cache() for name, llm in self.llms.items()}, self.health, self.explore_rate)
+
+    def route(self, node: str):
+        """按优先顺序返回本次调用要尝试的服务商名"""
+        names = list(self.llms)
+        healthy = [name for name in names if self.health.healthy(name, node)]
+        unhealthy = [name for name in names if name not in healthy]
+        # 没有样本的排在最前（按配置顺序），其余按延迟从低到高
+        latency = {name: self.health.latency(name, node) for name in names}
+        rank = lambda name: (latency[name] is not None, latency[name] or 0.0, names.index(name))
+        healthy.sort(key=rank)
+        unhealthy.sort(key=rank)
+        if len(healthy) > 1 and self.rng.random() < self.explore_rate:
+            healthy.insert(0, healthy.pop(self.rng.randrange(1, len(healthy))))
+        return healthy + unhealthy
+
+    def _failed(self, name, node, error, last: bool):
+        """记录失败；还有其他服务商可以尝试时计一次切换"""
+        self.health.record(name, node, error=True)
+        if not last:
+            record_usage(failovers=1)
+        return error
+
+    def invoke(self, system_prompt: str, user_prompt: str) -> str:
+        node = NODE_NAMES.get(system_prompt, "llm")
+        order, error = self.route(node), None
+        for attempt, name in enumerate(order):
+            start = time.monotonic()
+            try:
+                response = self.llms[name].invoke(system_prompt, user_prompt)
+            except Exception as e:
+                error = self._failed(name, node, e, last=attempt == len(order) - 1)
+                continue
+            self.health.record(name, node, latency=time.monotonic() - start)
+            return response
+        raise error
+
+    async def ainvoke(self, system_prompt: str, user_prompt: str) -> str:
+        node = NODE_NAMES.get(system_prompt, "llm")
+        order, error = self.route(node), None
+        for attempt, name in enumerate(order):
+            start = time.monotonic()
+            try:
+                response = await self.llms[name].ainvoke(system_prompt, user_prompt)
+            except Exception as e:
+                error = self._failed(name, node, e, last=attempt == len(order) - 1)
+                continue
+            self.health.record(name, node, latency=time.monotonic() - start)
+            return response
+        raise error
+
+    def stream(self, system_prompt: str, user_prompt: str) -> Iterator[str]:
+        node = NODE_NAMES.get(system_prompt, "llm")
+        order, error = self.route(node), None
+        for attempt, name in enumerate(order):
+            start, started = time.monotonic(), False
+            try:
+                for chunk in self.llms[name].stream(system_prompt, user_prompt):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if started:  # 已经输出的内容无法撤回，只能报错
+                    self.health.record(name, node, error=True)
+                    raise
+                error = self._failed(name, node, e, last=attempt == len(order) - 1)
+                continue
+            self.health.record(name, node, latency=time.monotonic() - start)
+            return
+        raise error
+
+    async def astream(self, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        node = NODE_NAMES.get(system_prompt, "llm")
+        order, error = self.route(node), None
+        for attempt, name in enumerate(order):
+            start, started = time.monotonic(), False
+            try:
+                async for chunk in self.llms[name].astream(system_prompt, user_prompt):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if started:
+                    self.health.record(name, node, error=True)
+                    raise
+                error = self._failed(name, node, e, last=attempt == len(order) - 1)
+                continue
+            self.health.record(name, node, latency=time.monotonic() - start)
+            return
+        raise error
+
+
+_health = None
+_health_lock = threading.Lock()
+
+def get_provider_health() -> ProviderHealth:
+    """惰性创建全局共享的服务商健康统计，所有路由器共用"""
+    global _health
+    with _health_lock:
+        if _health is None:
+            _health = ProviderHealth()
+    return _health
+
+def router_stats() -> dict:
+    return get_provider_health().stats()
+
+def create_llm_client(api_keys: dict = None, providers=LLM_PROVIDERS) -> BaseLLM:
+    """按 LLM_PROVIDERS 的顺序为配置了 API Key 的服务商创建客户端（各自带限流和对冲）；
+    多于一个时用 RouterLLM 组合。api_keys 覆盖 config 中的 Key，如界面中输入的 Key"""
+    keys = {"zhipu": ZHIPUAI_API_KEY, "gemini": GEMINI_API_KEY, **(api_keys or {})}
+    llms = {name: with_hedging(with_rate_limit(PROVIDERS[name](keys[name])))
+            for name in providers if keys.get(name)}
+    if not llms:
+        raise ValueError(f"没有可用的 LLM 服务商，请为 {', '.join(providers)} 之一配置 API Key")
+    if len(llms) == 1:
+        return next(iter(llms.values()))
+    return RouterLLM(llms, get_provider_health())
@@ -1,11 +1,45 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import Any, List, Optional
+
+from blobstore import get_blob_store
 
-@dataclass
 class Search:
-    """单个搜索结果的状态"""
-    url: str = ""          # 搜索结果的链接
-    content: str = ""      # 搜索返回的内容
+    """单个搜索结果的状态
+
+    内存中只保留正文的哈希和长度，正文存放在按内容去重的磁盘 blob 存储中（见 blobstore.py），
+    读取 content 时才加载，因此无论搜索多少轮、多少条结果，每个会话占用的内存都很小。"""
+    __slots__ = ("url", "content_hash", "content_length")
+
+    def __init__(self, url: str = "", content: str = "", content_hash: str = None, content_length: int = None):
+        self.url = url                          # 搜索结果的链接
+        if content_hash is None:
+            content_hash = get_blob_store().put(content)
+            content_length = len(content or "")
+        self.content_hash = content_hash        # 正文的 sha256
+        self.content_length = content_length or 0  # 正文字符数
+
+    @property
+    def content(self) -> str:
+        """搜索返回的内容，从 blob 存储中按需读取"""
+        return get_blob_store().get(self.content_hash)
+
+    def to_dict(self) -> dict:
+        return {"url": self.url, "content_hash": self.content_hash, "content_length": self.content_length}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Search":
+        # 兼容正文内联的旧格式
+        if "content" in data:
+            return cls(url=data.get("url", ""), content=data["content"])
+        return cls(url=data.get("url", ""), content_hash=data["content_hash"], content_length=data.get("content_length"))
+
+    def __eq__(self, other):
+        if not isinstance(other, Search):
+            return NotImplemented
+        return (self.url, self.content_hash) == (other.url, other.content_hash)
+
+    def __repr__(self):
+        return f"Search(url={self.url!r}, content_hash={self.content_hash[:12]!r}, content_length={self.content_length})"
 
 @dataclass
 class Research:
@@ -13,6 +47,7 @@ class Research:
     search_history: List[Search] = field(default_factory=list)  # 搜索记录列表
     latest_summary: str = ""                                    # 当前段落的最新总结
     reflection_iteration: int = 0                               # 反思迭代次数
+    stop_reason: str = ""                                       # 反思循环结束的原因（见 convergence.py）
 
 @dataclass
 class Paragraph:
@@ -20,12 +55,56 @@ class Paragraph:
     title: str = ""                # 段落标题
     content: str = ""              # 段落的预期内容（初始规划）
     research: Research = field(default_factory=Research)  # 研究进度
+    section: str = ""              # 格式化后的报告章节（分段格式化模式）
+
+    def to_dict(self) -> dict:
+        research = self.research
+        return {
+            "title": self.title,
+            "content": self.content,
+            "research": {
+                "search_history": [search.to_dict() for search in research.search_history],
+                "latest_summary": research.latest_summary,
+                "reflection_iteration": research.reflection_iteration,
+                "stop_reason": research.stop_reason,
+            },
+            "section": self.section,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Paragraph":
+        research = data.get("research", {})
+        return cls(
+            title=data.get("title", ""),
+            content=data.get("content", ""),
+            research=Research(
+                search_history=[Search.from_dict(search) for search in research.get("search_history", [])],
+                latest_summary=research.get("latest_summary", ""),
+                reflection_iteration=research.get("reflection_iteration", 0),
+                stop_reason=research.get("stop_reason", ""),
+            ),
+            section=data.get("section", ""),
+        )
 
 @dataclass
 class State:
     """整个报告的状态"""
     report_title: str = ""                    # 报告标题
     paragraphs: List[Paragraph] = field(default_factory=list)  # 段落列表
+    journal: Optional[Any] = field(default=None, repr=False, compare=False)  # 运行日志（journal.Journal），不参与序列化
+
+    def record(self, op: str, **data):
+        """向运行日志追加一条状态变更事件；未开启日志时什么也不做"""
+        if self.journal is not None:
+            self.journal.append(op, **data)
+
+    def to_dict(self) -> dict:
+        return {"report_title": self.report_title, "paragraphs": [p.to_dict() for p in self.paragraphs]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "State":
+        return cls(report_title=data.get("report_title", ""),
+                   paragraphs=[Paragraph.from_dict(p) for p in data.get("paragraphs", [])])
 
 
 if __name__ == "__main__":
@@ -1,13 +1,155 @@
-from tavily import TavilyClient
-from config import TAVILY_API_KEY
+import contextvars
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import SQLiteCache
+from corpus import get_local_corpus
+from hedging import get_hedger
+from ratelimit import get_rate_limiter
+from tracing import get_tracer
+from config import (TAVILY_API_KEY, SEARCH_CACHE_PATH, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES,
+                    SEARCH_CONNECT_TIMEOUT, SEARCH_READ_TIMEOUT, SEARCH_MAX_CONCURRENCY, SEARCH_DEADLINE)
+
+class SearchClient:
+    """长期复用的 Tavily 搜索客户端：连接池保持长连接，可跨线程共享，并限制同时进行的请求数"""
+    base_url = "https://api.tavily.com"
+
+    def __init__(self, api_key, connect_timeout=SEARCH_CONNECT_TIMEOUT, read_timeout=SEARCH_READ_TIMEOUT,
+                 max_concurrency=SEARCH_MAX_CONCURRENCY):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+        })
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def search(self, query, include_raw_content=True, max_results=5):
+        payload = {"query": query, "include_raw_content": include_raw_content, "max_results": max_results}
+        with self._semaphore:
+            response = self.session.post(f"{self.base_url}/search", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+_search_client = None
+_search_client_lock = threading.Lock()
+
+def get_search_client():
+    """惰性创建进程内共享的搜索客户端"""
+    global _search_client
+    with _search_client_lock:
+        if _search_client is None:
+            _search_client = SearchClient(TAVILY_API_KEY)
+    return _search_client
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+def get_search_cache():
+    """惰性创建全局搜索缓存；SEARCH_CACHE_PATH 为空时不启用缓存"""
+    global _search_cache
+    if not SEARCH_CACHE_PATH:
+        return None
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SQLiteCache(SEARCH_CACHE_PATH, ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_MAX_ENTRIES)
+    return _search_cache
+
+def normalize_query(query):
+    """归一化查询：全半角、大小写和多余空白的差异视为同一查询；保留标点和符号，"C#"、"C++" 与 "C" 是不同的查询"""
+    query = unicodedata.normalize("NFKC", query or "").lower()
+    return re.sub(r"\s+", " ", query).strip()
+
+def search_cache_key(query, include_raw_content, max_results):
+    key = json.dumps([normalize_query(query), bool(include_raw_content), max_results], ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
 def tavily_search(query, include_raw_content=True, max_results=5):
-    tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
+    tracer = get_tracer()
+    if tracer is None:
+        return _tavily_search(query, include_raw_content, max_results)
+    with tracer.span("tavily_search", "search", prompt_chars=len(query or ""), max_results=max_results) as span:
+        results = _tavily_search(query, include_raw_content, max_results, span)
+        span["results"] = len(results)
+        span["response_chars"] = sum(len(r.get("content") or "") for r in results)
+    return results
+
+def _tavily_search(query, include_raw_content=True, max_results=5, span=None):
+    cache = get_search_cache()
+    key = search_cache_key(query, include_raw_content, max_results)
+    if cache is not None:
+        cached = cache.get(key)
+        if span is not None:
+            span["cache_hit"] = cached is not None
+        if cached is not None:
+            return cached
+
+    # 未命中缓存时才占用 Tavily 的限额；限流和服务端错误按退避策略重试，慢请求发出对冲请求，整体不超过 SEARCH_DEADLINE
+    limiter = get_rate_limiter("tavily")
+    results = get_hedger().call("tavily_search", lambda: limiter.call(
+        lambda: get_search_client().search(query, include_raw_content=include_raw_content, max_results=max_results)
+    ), deadline=SEARCH_DEADLINE)['results']
+    if cache is not None:
+        cache.set(key, results)
+    return results
+
+def local_search(query, max_results=5):
+    """从本地语料库召回；未开启语料库时返回空列表"""
+    corpus = get_local_corpus()
+    if corpus is None:
+        return []
+    tracer = get_tracer()
+    if tracer is None:
+        return corpus.search(query, max_results)
+    with tracer.span("local_search", "search", prompt_chars=len(query or ""), max_results=max_results) as span:
+        results = corpus.search(query, max_results)
+        span["results"] = len(results)
+    return results
+
+def search(query, include_raw_content=True, max_results=5, keep=None):
+    """先从本地语料库召回，召回不足时再调用网络搜索，新抓取的结果写入语料库
+
+    keep 用于过滤结果（如去掉本次运行已经用过的）；本地结果过滤后仍有 max_results 条时不再调用网络搜索"""
+    keep = keep or (lambda results: results)
+    local = keep(local_search(query, max_results))
+    if len(local) >= max_results:
+        return local[:max_results]
+
+    results = tavily_search(query, include_raw_content=include_raw_content, max_results=max_results)
+    corpus = get_local_corpus()
+    if corpus is not None:
+        corpus.add(results)
+    seen = {result["url"] for result in local}
+    return (local + keep([result for result in results if result["url"] not in seen]))[:max_results]
 
-    return tavily_client.search(query,
-                                include_raw_content=include_raw_content,
-                                max_results=max_results,
-                                timeout=240)['results']
+def search_many(queries, include_raw_content=True, max_results=5, keep=None):
+    """并发执行多个搜索查询（每个查询先查本地语料库），按查询顺序合并结果；同一 URL 只保留第一次出现"""
+    if len(queries) == 1:
+        return search(queries[0], include_raw_content=include_raw_content, max_results=max_results, keep=keep)
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        # 复制上下文，让追踪属性跟随到搜索线程
+        futures = [executor.submit(contextvars.copy_context().run, search, query,
+                                   include_raw_content=include_raw_content, max_results=max_results, keep=keep)
+                   for query in queries]
+        merged, seen = [], set()
+        for future in futures:
+            for result in future.result():
+                if result["url"] not in seen:
+                    seen.add(result["url"])
+                    merged.append(result)
+    return merged
 
 if __name__ == "__main__":
     # 示例使用
@@ -21,4 +163,6 @@ if __name__ == "__main__":
     for i, result in enumerate(tavily_results, 1):
         print(f"{i}. {result['title']}")
         print(f"   链接: {result['url']}")
-        print(f"   内容: {result['content'][:100]}...\n")
\ No newline at end of file
+        print(f"   内容: {result['content'][:100]}...\n")
+    if get_search_cache() is not None:
+        print("缓存统计:", get_search_cache().stats())
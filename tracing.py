@@ -0,0 +1,178 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from prompts import (SYSTEM_PROMPT_REPORT_STRUCTURE, SYSTEM_PROMPT_FIRST_SEARCH, SYSTEM_PROMPT_FIRST_SUMMARY,
+                     SYSTEM_PROMPT_REFLECTION, SYSTEM_PROMPT_REFLECTION_MULTI, SYSTEM_PROMPT_REFLECTION_SUMMARY,
+                     SYSTEM_PROMPT_REFLECTION_SUMMARY_DELTA, SYSTEM_PROMPT_REPORT_FORMATTING,
+                     SYSTEM_PROMPT_SECTION_FORMATTING, SYSTEM_PROMPT_REPORT_OUTLINE)
+from config import TRACE_ENABLED
+
+# 通过系统提示词识别发起调用的节点
+NODE_NAMES = {
+    SYSTEM_PROMPT_REPORT_STRUCTURE: "ReportStructureNode",
+    SYSTEM_PROMPT_FIRST_SEARCH: "FirstSearchNode",
+    SYSTEM_PROMPT_FIRST_SUMMARY: "FirstSummaryNode",
+    SYSTEM_PROMPT_REFLECTION: "ReflectionNode",
+    SYSTEM_PROMPT_REFLECTION_MULTI: "ReflectionNode",
+    SYSTEM_PROMPT_REFLECTION_SUMMARY: "ReflectionSummaryNode",
+    SYSTEM_PROMPT_REFLECTION_SUMMARY_DELTA: "ReflectionSummaryNode",
+    SYSTEM_PROMPT_REPORT_FORMATTING: "ReportFormattingNode",
+    SYSTEM_PROMPT_SECTION_FORMATTING: "SectionFormattingNode",
+    SYSTEM_PROMPT_REPORT_OUTLINE: "ReportOutlineNode",
+}
+
+_context = contextvars.ContextVar("trace_context", default={})     # 运行 ID、段落序号、反思轮次等
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+@contextmanager
+def trace_context(**attrs):
+    """在 with 块内为之后的所有 span 附加属性（如 run、paragraph、round）"""
+    token = _context.set({**_context.get(), **attrs})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def record_usage(input_tokens=None, output_tokens=None, **extra):
+    """供 LLM 客户端上报提供商返回的 token 用量，写入当前 span；未开启追踪时什么也不做"""
+    span = _current_span.get()
+    if span is None:
+        return
+    if input_tokens is not None:
+        span["input_tokens"] = span.get("input_tokens", 0) + input_tokens
+    if output_tokens is not None:
+        span["output_tokens"] = span.get("output_tokens", 0) + output_tokens
+    for key, value in extra.items():
+        if value is not None:
+            span[key] = span.get(key, 0) + value
+
+def iterate_in_span(span, iterator):
+    """逐个取出 iterator 的片段，只在取片段期间把 span 设为当前 span，yield 之后即恢复，不会泄漏到调用方的上下文"""
+    while True:
+        token = _current_span.set(span)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _current_span.reset(token)
+        yield chunk
+
+async def aiterate_in_span(span, iterator):
+    """iterate_in_span 的异步版本"""
+    while True:
+        token = _current_span.set(span)
+        try:
+            chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            _current_span.reset(token)
+        yield chunk
+
+
+class Tracer:
+    """收集每次 LLM 和搜索调用的 span，导出 Chrome trace-event 格式的 JSON 及汇总计数"""
+
+    COUNTED = ("prompt_chars", "response_chars", "input_tokens", "cached_input_tokens", "output_tokens")
+
+    def __init__(self):
+        self.events = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, cat, activate=True, **args):
+        """记录一次调用；with 块内可以往返回的字典里补充属性
+
+        activate 为 False 时不把它设为当前 span，用于生成器：生成器在 yield 之间会把上下文留给调用方，
+        应改用 iterate_in_span 只在取下一个片段期间设置当前 span"""
+        attrs = {**_context.get(), **args}
+        token = _current_span.set(attrs) if activate else None
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except GeneratorExit:
+            raise  # 流式调用被提前关闭，不算错误
+        except BaseException as e:
+            attrs["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            end = time.perf_counter()
+            if token is not None:
+                _current_span.reset(token)
+            event = {
+                "name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": round((start - self._origin) * 1e6), "dur": round((end - start) * 1e6), "args": attrs,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def instant(self, name, cat, **args):
+        """记录一个没有持续时间的事件，如段落停止反思"""
+        event = {"name": name, "cat": cat, "ph": "i", "s": "t", "pid": os.getpid(), "tid": threading.get_ident(),
+                 "ts": round((time.perf_counter() - self._origin) * 1e6), "args": {**_context.get(), **args}}
+        with self._lock:
+            self.events.append(event)
+
+    def _events(self, run=None):
+        with self._lock:
+            return [e for e in self.events if run is None or e["args"].get("run") == run]
+
+    def summary(self, run=None):
+        """按调用名汇总：次数、错误数、耗时、提示词/响应大小和 token 用量（输入 token 分为命中服务端缓存和未命中的部分）"""
+        counters = defaultdict(lambda: defaultdict(int))
+        for event in self._events(run):
+            c = counters[event["name"]]
+            c["calls"] += 1
+            c["errors"] += "error" in event["args"]
+            c["total_ms"] += event.get("dur", 0) / 1000
+            c["max_ms"] = max(c["max_ms"], event.get("dur", 0) / 1000)
+            if "reason" in event["args"]:
+                c[f"reason:{event['args']['reason']}"] += 1
+            for key in self.COUNTED:
+                c[key] += event["args"].get(key) or 0
+        for c in counters.values():
+            c["uncached_input_tokens"] = c["input_tokens"] - c["cached_input_tokens"]
+        return {name: {k: round(v, 1) if isinstance(v, float) else v for k, v in c.items()}
+                for name, c in counters.items()}
+
+    def export(self, path, run=None):
+        """导出 JSON，可直接在 chrome://tracing 或 Perfetto 中打开
+
+        导出后从内存中移除这些事件（run 为 None 时移除全部），长期运行的进程不会无限累积；
+        需要汇总计数时应在导出之前调用 summary"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self._events(run), "displayTimeUnit": "ms",
+                       "metadata": {"run": run, "summary": self.summary(run)}}, f, ensure_ascii=False)
+        self.discard(run)
+        return path
+
+    def discard(self, run=None):
+        """丢弃某次运行的事件；run 为 None 时丢弃全部"""
+        with self._lock:
+            self.events = [e for e in self.events if run is not None and e["args"].get("run") != run]
+
+
+_tracer = Tracer() if TRACE_ENABLED else None
+
+def record_event(name, cat, **args):
+    """记录一个即时事件；未开启追踪时什么也不做"""
+    if _tracer is not None:
+        _tracer.instant(name, cat, **args)
+
+def get_tracer():
+    return _tracer
+
+def enable_tracing():
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
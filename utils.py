@@ -1,6 +1,7 @@
 from state import Search
 import json
 import re
+import threading
 
 from json.decoder import JSONDecodeError
 
@@ -13,6 +14,132 @@ def clean_json_tags(text):
 def clean_markdown_tags(text):
     return text.replace("```markdown\n", "").replace("\n```", "")
 
+class MarkdownStreamCleaner:
+    """remove_reasoning_from_output + clean_markdown_tags 的流式版本：
+    丢弃开头的 <think>...</think> 推理内容和 ```markdown 标记，并暂存末尾几个字符以去掉结尾的 ```"""
+    THINK_START, THINK_END = "<think>", "</think>"
+    FENCE_START, FENCE_END = "```markdown\n", "\n```"
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False  # 是否已越过开头的推理内容和代码块标记
+
+    def feed(self, chunk: str) -> str:
+        """输入一段新文本，返回当前可以安全输出的部分"""
+        self.buffer += chunk
+        if not self.started and not self._skip_head():
+            return ""
+        # 暂存末尾的空白和可能是结尾标记的几个字符，结尾是 "\n```\n" 时也能完整去掉
+        split = max(0, len(self.buffer.rstrip()) - len(self.FENCE_END))
+        out, self.buffer = self.buffer[:split], self.buffer[split:]
+        return out
+
+    def finish(self) -> str:
+        """输入结束，返回剩余部分"""
+        if not self.started:
+            return clean_markdown_tags(remove_reasoning_from_output(self.buffer))
+        out, self.buffer = self.buffer.rstrip(), ""  # 与 remove_reasoning_from_output 一样去掉末尾空白
+        return out[:-len(self.FENCE_END)] if out.endswith(self.FENCE_END) else out
+
+    def _skip_head(self) -> bool:
+        stripped = self.buffer.lstrip()
+        if stripped.startswith(self.THINK_START):
+            if self.THINK_END not in stripped:
+                return False
+            stripped = stripped.split(self.THINK_END)[-1].lstrip()
+        if self.THINK_START.startswith(stripped) or self.FENCE_START.startswith(stripped):
+            self.buffer = stripped
+            return False  # 还无法判断开头是不是标记，继续等待
+        if stripped.startswith(self.FENCE_START):
+            stripped = stripped[len(self.FENCE_START):]
+        self.buffer = stripped
+        self.started = True
+        return True
+
+class JSONArrayStreamParser:
+    """流式解析 LLM 输出的 JSON 数组：每当数组中的一个对象完整闭合，就立即返回该对象
+
+    会跳过开头的 <think>...</think> 推理内容以及 ```json 等数组之前的文本"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0           # 下一个待扫描字符在 buffer 中的位置
+        self.depth = 0         # 当前括号深度，进入顶层数组后为 1
+        self.in_string = False
+        self.escaped = False
+        self.start = None      # 当前对象在 buffer 中的起始位置
+        self.done = False      # 顶层数组已闭合
+
+    def feed(self, chunk: str) -> list:
+        """输入一段新文本，返回其中新闭合的对象列表"""
+        self.buffer += chunk
+        if self.depth == 0 and not self._find_array():
+            return []
+        items = []
+        while self.pos < len(self.buffer) and not self.done:
+            ch = self.buffer[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                if self.depth == 1 and ch == "{":
+                    self.start = self.pos
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 1 and ch == "}" and self.start is not None:
+                    items.append(json.loads(self.buffer[self.start:self.pos + 1]))
+                    self.start = None
+                elif self.depth == 0:
+                    self.done = True
+            self.pos += 1
+        # 丢弃已经解析完的文本
+        keep = self.start if self.start is not None else self.pos
+        self.buffer, self.pos = self.buffer[keep:], self.pos - keep
+        if self.start is not None:
+            self.start = 0
+        return items
+
+    def _find_array(self) -> bool:
+        text = self.buffer.lstrip()
+        if text.startswith("<think>"):
+            if "</think>" not in text:
+                return False
+            text = text.split("</think>", 1)[1]
+        index = text.find("[")
+        if index < 0:
+            return False
+        self.buffer, self.pos, self.depth = text, index + 1, 1
+        return True
+
+def clean_markdown_stream(chunks):
+    """对流式输出的 Markdown 逐段清理"""
+    cleaner = MarkdownStreamCleaner()
+    for chunk in chunks:
+        out = cleaner.feed(chunk)
+        if out:
+            yield out
+    out = cleaner.finish()
+    if out:
+        yield out
+
+async def aclean_markdown_stream(chunks):
+    """clean_markdown_stream 的异步版本"""
+    cleaner = MarkdownStreamCleaner()
+    async for chunk in chunks:
+        out = cleaner.feed(chunk)
+        if out:
+            yield out
+    out = cleaner.finish()
+    if out:
+        yield out
+
 def extract_clean_response(response: str) -> dict:
     """处理 LLM 返回的响应，提取搜索信息"""
     try:
@@ -40,16 +167,96 @@ def extract_clean_response(response: str) -> dict:
         reason_match = re.search(r'"reasoning":\s*"([^"]*)"', response)
         if reason_match:
             reasoning = reason_match.group(1)
-            
-        return {
+
+        result = {
             "search_query": search_query,
             "reasoning": reasoning or "从响应中提取的查询"
         }
 
+        # 多查询反思：尝试匹配 search_queries 数组
+        queries_match = re.search(r'"search_queries":\s*\[([^\]]*)', response)
+        if queries_match:
+            queries = re.findall(r'"([^"]*)"', queries_match.group(1))
+            if queries:
+                result["search_queries"] = queries
+                result["search_query"] = queries[0]
+        return result
+
+def split_summary_blocks(text: str, max_chars: int = 300):
+    """把段落总结切分为编号文本块，供增量总结使用：每行一组，超过 max_chars 的行再按句末标点切分后合并到不超过 max_chars
+
+    返回 [(行号, 文本)]，同一行的块按顺序拼接即为原行"""
+    blocks = []
+    for line_no, line in enumerate((text or "").split("\n")):
+        if not line.strip():
+            continue
+        pieces = [line] if len(line) <= max_chars else [p for p in re.split(r"(?<=[。！？；!?;])", line) if p]
+        current = ""
+        for piece in pieces:
+            if current and len(current) + len(piece) > max_chars:
+                blocks.append((line_no, current))
+                current = ""
+            current += piece
+        if current:
+            blocks.append((line_no, current))
+    return blocks
+
+def parse_index(value):
+    """模型给出的编号：整数或纯数字字符串（如 "3"），其他值返回 None"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+def apply_summary_delta(text: str, delta: dict, max_chars: int = 300) -> str:
+    """把增量总结的 edits（替换编号块）和 additions（在编号块所在行之后新增段落）合并到段落总结中
+
+    块编号与 split_summary_blocks(text, max_chars) 一致；空的修改和不存在的编号被忽略，
+    插入位置无效的新增内容追加到末尾，不会删除已有内容"""
+    blocks = split_summary_blocks(text, max_chars)
+    texts = [block_text for _, block_text in blocks]
+    for edit in delta.get("edits") or []:
+        if not isinstance(edit, dict):
+            continue
+        block_id, new_text = parse_index(edit.get("id")), str(edit.get("text") or "").strip()
+        if block_id is not None and 0 <= block_id < len(texts) and new_text:
+            texts[block_id] = new_text
+
+    inserted, appended = {}, []
+    for addition in delta.get("additions") or []:
+        new_text = str(addition.get("text") or "").strip() if isinstance(addition, dict) else str(addition).strip()
+        if not new_text:
+            continue
+        after = parse_index(addition.get("after")) if isinstance(addition, dict) else None
+        if after is not None and 0 <= after < len(blocks):
+            inserted.setdefault(blocks[after][0], []).append(new_text)
+        else:
+            appended.append(new_text)
+
+    lines = (text or "").split("\n")
+    for line_no in range(len(lines)):
+        ids = [i for i, (block_line, _) in enumerate(blocks) if block_line == line_no]
+        if ids:
+            lines[line_no] = "".join(texts[i] for i in ids)
+        for new_text in inserted.get(line_no, []):
+            lines[line_no] += f"\n\n{new_text}"
+    result = "\n".join(lines).strip()
+    for new_text in appended:
+        result = f"{result}\n\n{new_text}" if result else new_text
+    return result
+
+# 多个段落并发研究时共享同一个 State，写入搜索记录需要加锁
+_state_lock = threading.Lock()
+
 def update_state_with_search_results(search_results, idx_paragraph, state):
     
-    for search_result in search_results:
-        search = Search(url=search_result["url"], content=search_result["content"])
-        state.paragraphs[idx_paragraph].research.search_history.append(search)
+    searches = [Search(url=search_result["url"], content=search_result["content"]) for search_result in search_results]
+    with _state_lock:
+        state.paragraphs[idx_paragraph].research.search_history.extend(searches)
+    # 日志只记录链接、标题和正文哈希，正文已在 blob 存储中，raw_content 等其他字段不再使用
+    state.record("search_results", idx=idx_paragraph,
+                 results=[{"title": search_result.get("title", ""), **search.to_dict()}
+                          for search_result, search in zip(search_results, searches)])
 
     return state
\ No newline at end of file